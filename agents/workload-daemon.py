@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import argparse
+import glob
+import imp
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import workload_client
+
+# Scaling back ends, by the "backend" named in a workload's configuration.
+BACKENDS = {
+	"generic": "workload-generic.py",
+	"sahara": "workload-sahara.py",
+}
+# Seconds between looks at the configuration directory for added, changed
+# or removed workloads.
+RESCAN_INTERVAL = 30
+
+
+class Daemon(object):
+	"""
+	Watches every workload configured in one directory from one process.
+
+	Each *.cfg file is a workload configuration as written by an agent's
+	register command, plus an optional "backend" ("generic", the default,
+	or "sahara"). Every workload gets its own watch thread, so a slow scale
+	never holds up the others, and all of them share one WorkloadClient:
+	one keystone token and one connection pool.
+	"""
+
+	def __init__(self, config_dir):
+		self.config_dir = config_dir
+		self.client = workload_client.WorkloadClient()
+		self.backends = {}
+		self.watchers = {}
+
+	def backend(self, name):
+		if name not in self.backends:
+			path = os.path.join(os.path.dirname(os.path.abspath(__file__)), BACKENDS[name])
+			self.backends[name] = imp.load_source("workload_" + name, path)
+		return self.backends[name]
+
+	def scan(self):
+		"""
+		Start watching new workloads, restart those whose configuration
+		changed and stop watching removed ones.
+		"""
+		paths = set(glob.glob(os.path.join(self.config_dir, "*.cfg")))
+		for path in paths:
+			watcher = self.watchers.get(path)
+			if watcher and watcher["stop"].is_set():
+				if watcher["thread"].is_alive():
+					# Let it finish the batch it was on first, so the two
+					# never carry out the same orders.
+					continue
+				del self.watchers[path]
+				watcher = None
+			try:
+				mtime = os.path.getmtime(path)
+				if watcher and watcher["mtime"] == mtime:
+					continue
+				config = json.loads(open(path).read())
+				backend = self.backend(config.get("backend", "generic"))
+			except Exception as e:
+				workload_client.say("Skipping %s: %s" % (path, e))
+				continue
+
+			if watcher:
+				if config == watcher["config"]:
+					watcher["mtime"] = mtime
+					continue
+				# The watch thread keeps the config and scale function
+				# it started with; replace it once it has stopped.
+				watcher["stop"].set()
+				workload_client.say("Restarting %s for its new configuration" % watcher["config"]['name'])
+				continue
+
+			stop = threading.Event()
+			thread = threading.Thread(target=workload_client.watch,
+				args=(self.client, config, backend.scale, stop, "[%s] " % config['name']))
+			thread.daemon = True
+			thread.start()
+			self.watchers[path] = {"mtime": mtime, "config": config, "stop": stop, "thread": thread}
+			workload_client.say("Watching %s (%s)" % (config['name'], config.get("backend", "generic")))
+
+		for path in set(self.watchers) - paths:
+			watcher = self.watchers.pop(path)
+			watcher["stop"].set()
+			workload_client.say("Stopped watching %s" % watcher["config"]['name'])
+
+	def run(self, stop):
+		while not stop.is_set():
+			self.scan()
+			stop.wait(RESCAN_INTERVAL)
+		for watcher in self.watchers.values():
+			watcher["stop"].set()
+
+
+if __name__ == '__main__':
+
+	# We roll unbuffered.
+
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+	socket._fileobject.default_bufsize = 0
+
+	parser = argparse.ArgumentParser(
+		description="Watch every workload configured in a directory from one process.")
+	parser.add_argument('config_dir', nargs='?', default='workloads.d',
+		help="directory of workload *.cfg files (default: workloads.d)")
+	args = parser.parse_args()
+
+	stop = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+	Daemon(args.config_dir).run(stop)
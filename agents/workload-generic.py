@@ -17,35 +17,46 @@
 
 import json
 import argparse
-import urllib2
 import sys
 import os
 import re
 import socket
 import keystoneclient.v2_0
+import novaclient.exceptions
 import novaclient.v1_1
 import time
 import random
 import string
+import threading
+import Queue
+import workload_client
+
+# Multi-create requests made for one scale-up order before giving up.
+CREATE_ATTEMPTS = 3
+# Seconds to back off after the first failed multi-create; doubled after each.
+CREATE_BACKOFF = 5
+# Seconds to wait for a batch of servers to leave BUILD.
+BUILD_TIMEOUT = 600
+# Image (matched as a substring) and flavor booted when the workload's
+# configuration doesn't name its own.
+DEFAULT_IMAGE = "Ubuntu 14.04.1 Server"
+DEFAULT_FLAVOR = "m1.medium"
+# Seconds a resolved image or flavor id is reused before looking it up again.
+RESOURCE_CACHE_TTL = 3600
+
+RESOURCE_CACHE = workload_client.FileCache(os.getenv("OS_WORKLOAD_RESOURCE_CACHE",
+	os.path.expanduser("~/.workload-agent-resources.json")))
+# Deletes in flight at once for a scale-down order.
+DELETE_CONCURRENCY = 10
+# Seconds to wait for a scale-down's servers to be gone before acknowledging.
+DELETE_TIMEOUT = 300
+# Servers this agent boots are named <workload>-XXXXX, or -XXXXX-N when
+# booted in a batch.
+SERVER_NAME_SUFFIX = re.compile(r"^-[A-Z0-9]{5}(-[0-9]+)?$")
+
+COMPUTE = None
 
 
-def get_nova():
-
-	keystone = keystoneclient.v2_0.client.Client(username=os.getenv("OS_USERNAME"),
-							password=os.getenv("OS_PASSWORD"),
-							tenant_id=os.getenv("OS_TENANT_ID"),
-							auth_url=os.getenv("OS_AUTH_URL"))
-	
-	compute_catalog = keystone.service_catalog.get_endpoints()['computev21']
-	
-	cluster_endpoint = None
-	
-	for endpoint in compute_catalog:
-		if endpoint['region'] == os.getenv("OS_REGION_NAME"):
-			cluster_endpoint = endpoint
-
-	return (keystone.auth_token, cluster_endpoint)
-
 # Register Workload
 def register(workload, priority):
 	"""
@@ -53,37 +64,21 @@ def register(workload, priority):
 	"""
 	print "Registering "+workload
 
-	auth_token, cluster_endpoint = get_nova()
-
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads",
-		json.dumps({"workload":{"name":workload,"priority":priority}}), {'Content-type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "POST"
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-	
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("POST", "/os-workloads",
+		{"workload":{"name":workload,"priority":priority}}).body
 
 	config = open('workload-generic.cfg', 'w')
-	workload = {"name":response_json['workload']['name'],"id":response_json['workload']['id']}
+	workload = {"name":response_json['workload']['name'],"id":response_json['workload']['id'],
+		"image":DEFAULT_IMAGE,"flavor":DEFAULT_FLAVOR,"victim_policy":"newest-first"}
 	config.write(json.dumps(workload))
 	config.close()
 	print "Wrote configuration"
 
 
 def list_workloads():
-	auth_token, cluster_endpoint = get_nova()
-
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads",
-		None, {'X-Auth-Token':auth_token})
-
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-		
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("GET", "/os-workloads").body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 def delete():
@@ -91,110 +86,225 @@ def delete():
 	Delete a workload.
 	"""
 	config = json.loads(open("workload-generic.cfg").read())
-	auth_token, cluster_endpoint = get_nova()
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		None, {'X-Auth-Token':auth_token})
-	request.get_method = lambda: "DELETE"
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-		
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("DELETE", "/os-workloads/"+str(config['id'])).body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 def watch():
 	"""
+	Carry out this workload's orders until interrupted.
+	"""
+	config = json.loads(open("workload-generic.cfg").read())
+	workload_client.watch(workload_client.WorkloadClient(), config, scale)
 
+def scale(net,config):
 	"""
-	# Watch Workload
+	Add or remove net servers; return how many were (negative: removed).
+	"""
+	if net > 0:
+		return create_instances(net,config)
+	return -delete_instances(net*-1,config)
 
-	config = json.loads(open("workload-generic.cfg").read())
+def get_compute():
+	"""
+	The novaclient shared by every scale operation, so it authenticates once.
+	"""
+	global COMPUTE
+	if COMPUTE is None:
+		COMPUTE = novaclient.v1_1.client.Client(os.getenv('OS_USERNAME'),os.getenv('OS_PASSWORD'),os.getenv('OS_TENANT_NAME'),auth_url=os.getenv('OS_AUTH_URL'))
+	return COMPUTE
 
-	auth_token, cluster_endpoint = get_nova()
-		
-	keystone_timeout = time.time()
+def resource_key(kind, name):
+	return "|".join([os.getenv('OS_AUTH_URL') or "", os.getenv('OS_TENANT_NAME') or "", kind, name])
 
-	while True:
+def resolve(nova, kind, name):
+	"""
+	Return the id of the image or flavor called name.
 
-		if time.time() - keystone_timeout > 300:
-			auth_token, cluster_endpoint = get_nova()
-			keystone_timeout = time.time()
-
-		#  Watch for new orders
-		#try:
-		request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-			None, {'X-Auth-Token':auth_token})
-		response = urllib2.urlopen(request).read()
-		response_json = json.loads(response)
-		orders = response_json['orders']
-		#except:
-		#	orders = None
-
-		#  Execute orders (spin up instances, spin down instances)
-		if orders:
-			for order in orders:
-				print "New order: "+str(order['id'])
-				if order['instances'] > 0:
-					create_instances(order['instances'],config)
-				if order['instances'] < 0:
-					delete_instances(order['instances']*-1,config)
-				acknowledge_order(config,order,auth_token,cluster_endpoint)
-
-		time.sleep(2)
-
-def acknowledge_order(config,order,auth_token, cluster_endpoint):
-	print "Acknowledging Order "+str(order['id'])
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		json.dumps({"order": [{"id": order['id'], "status": "FILLED"}]}), {'Content-Type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "PUT"
-	response = urllib2.urlopen(request).read()
-	return True
+	Ids are cached in memory and on disk for RESOURCE_CACHE_TTL seconds,
+	so most scale-ups don't list the catalog at all.
+	"""
+	key = resource_key(kind, name)
+	entry = RESOURCE_CACHE.get(key)
+	if entry:
+		return entry['id']
+
+	resolved = None
+	if kind == "image":
+		for image in nova.images.list():
+			if name in image.name:
+				resolved = image.id
+	else:
+		for flavor in nova.flavors.list():
+			if flavor.name == name:
+				resolved = flavor.id
+	if resolved is None:
+		raise Exception("No %s found with name %s" % (kind, name))
+
+	RESOURCE_CACHE.put(key, {"id": resolved, "expires": time.time() + RESOURCE_CACHE_TTL})
+	return resolved
 
 def create_instances(count,config):
-	requested_image = None
-	nova = novaclient.v1_1.client.Client(os.getenv('OS_USERNAME'),os.getenv('OS_PASSWORD'),os.getenv('OS_TENANT_NAME'),auth_url=os.getenv('OS_AUTH_URL'))
-
-	for image in nova.images.list():
-		if "Ubuntu 14.04.1 Server" in image.name:
-			requested_image = image
-	
-	requested_group = None
+	nova = get_compute()
+	image_name = config.get('image', DEFAULT_IMAGE)
+	flavor_name = config.get('flavor', DEFAULT_FLAVOR)
+
+	launched = 0
+	attempts = 0
+	while launched < count and attempts < CREATE_ATTEMPTS:
+		attempts += 1
+		wanted = count - launched
+		server_name = config['name'] + "-" + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
+		try:
+			requested_image = resolve(nova, "image", image_name)
+			requested_flavor = resolve(nova, "flavor", flavor_name)
+			# One request for the whole batch; nova boots as many as it
+			# can, at least one, naming them server_name-1, -2, ...
+			nova.servers.create(server_name,
+						requested_image,
+						requested_flavor,
+						security_groups=['default'],
+						meta={"workload_id": str(config['id'])},
+						min_count=1,
+						max_count=wanted)
+			print "Creating %d Servers: %s" % (wanted, server_name)
+		except Exception as e:
+			print "Exception on create: ", e
+			if isinstance(e, (novaclient.exceptions.BadRequest, novaclient.exceptions.NotFound)):
+				# Perhaps a cached image or flavor has gone; look them up again.
+				RESOURCE_CACHE.delete(resource_key("image", image_name))
+				RESOURCE_CACHE.delete(resource_key("flavor", flavor_name))
+			time.sleep(CREATE_BACKOFF * 2 ** (attempts - 1))
+			continue
+
+		servers = wait_for_build(nova, server_name)
+		for server in servers:
+			if server.status == "ERROR":
+				print "Server failed to build, deleting: "+server.name
+				nova.servers.delete(server)
+			else:
+				launched += 1
+		print "Launched %d of %d servers" % (launched, count)
+
+	return launched
+
+def wait_for_build(nova, server_name):
+	"""
+	Wait for every server in a multi-create batch to leave BUILD and
+	return them.
+	"""
+	deadline = time.time() + BUILD_TIMEOUT
+	delay = 1
+	while True:
+		servers = [server for server in nova.servers.list(search_opts={'name': server_name})
+				if server.name.startswith(server_name)]
+		if time.time() > deadline or not [s for s in servers if s.status == "BUILD"]:
+			return servers
+		time.sleep(delay)
+		delay = min(delay * 2, 10)
 
-	for group in nova.security_groups.list():
-		if "default" in group.name:
-			requested_group = group
+def newest_first(servers):
+	return sorted(servers, key=lambda server: server.created, reverse=True)
 
-	requested_flavor = None
-	
-	for flavor in nova.flavors.list():
-		if flavor.name == "m1.medium":
-			requested_flavor = flavor
+def oldest_first(servers):
+	return sorted(servers, key=lambda server: server.created)
 
-	for c in xrange(count):
-		server_name = config['name'] + "-" + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
+def least_loaded(servers):
+	"""
+	Servers doing no work (not ACTIVE) first, then by the "load" the
+	workload reports in each server's metadata, then newest first.
+	"""
+	def load(server):
 		try:
-			my_server = nova.servers.create(server_name,
-									requested_image,
-									requested_flavor,
-									security_groups=['default'])
-			print "Creating Server: "+server_name
-			time.sleep(2)
-			server = nova.servers.get(my_server)
-		except:
-			print "Exception on create, skipping server."
-			time.sleep(20)
+			return float(server.metadata.get("load", 0))
+		except ValueError:
+			return 0.0
+	return sorted(newest_first(servers),
+		key=lambda server: (server.status == "ACTIVE", load(server)))
+
+# Scale-down victim selection, picked with "victim_policy" in the
+# workload's configuration.
+VICTIM_POLICIES = {
+	"newest-first": newest_first,
+	"oldest-first": oldest_first,
+	"least-loaded": least_loaded,
+}
+
+def regex_escape(text):
+	return re.sub(r"([\\.^$*+?()\[\]{}|])", r"\\\1", text)
+
+def workload_servers(nova, config):
+	"""
+	This workload's live servers.
+
+	Nova filters on the name prefix; servers are then matched on the
+	workload_id metadata we boot them with, or for older servers on the
+	exact name pattern, so workloads sharing a name prefix are left alone.
+	"""
+	servers = []
+	for server in nova.servers.list(search_opts={'name': "^" + regex_escape(config['name']) + "-"}):
+		workload_id = server.metadata.get("workload_id")
+		if workload_id is not None:
+			if workload_id != str(config['id']):
+				continue
+		elif not server.name.startswith(config['name']) or \
+				not SERVER_NAME_SUFFIX.match(server.name[len(config['name']):]):
+			continue
+		if server.status == "DELETED" or getattr(server, "OS-EXT-STS:task_state", None) == "deleting":
+			continue
+		servers.append(server)
+	return servers
 
 def delete_instances(count,config):
-	c = count
-	nova = novaclient.v1_1.client.Client(os.getenv('OS_USERNAME'),os.getenv('OS_PASSWORD'),os.getenv('OS_TENANT_NAME'),auth_url=os.getenv('OS_AUTH_URL'))
+	"""
+	Delete count of this workload's servers and return how many are gone.
 
-	for server in nova.servers.list():
-		if server.name.startswith(config['name']) and c > 0:
+	Victims are picked by the workload's victim_policy and deleted
+	DELETE_CONCURRENCY at a time. We wait for them to disappear so the
+	quota they free is visible to other workloads once we acknowledge.
+	"""
+	nova = get_compute()
+	policy = VICTIM_POLICIES[config.get('victim_policy', "newest-first")]
+	victims = policy(workload_servers(nova, config))[:count]
+
+	work = Queue.Queue()
+	for server in victims:
+		work.put(server)
+	failed = []
+
+	def deleter():
+		while True:
+			try:
+				server = work.get_nowait()
+			except Queue.Empty:
+				return
 			print "Deleting "+server.name
-			nova.servers.delete(server)
-			c = c - 1
-			time.sleep(1)
+			try:
+				nova.servers.delete(server)
+			except novaclient.exceptions.NotFound:
+				pass
+			except Exception as e:
+				print "Failed to delete "+server.name+": ", e
+				failed.append(server)
+
+	threads = [threading.Thread(target=deleter) for _ in range(min(DELETE_CONCURRENCY, len(victims)))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	deleting = set(server.id for server in victims) - set(server.id for server in failed)
+	deadline = time.time() + DELETE_TIMEOUT
+	delay = 1
+	remaining = deleting
+	while remaining and time.time() < deadline:
+		time.sleep(delay)
+		delay = min(delay * 2, 10)
+		remaining = deleting & set(server.id for server in
+			nova.servers.list(search_opts={'name': "^" + regex_escape(config['name']) + "-"}))
+	deleted = len(deleting - remaining)
+	print "Deleted %d of %d servers" % (deleted, count)
+	return deleted
 
 
 # Request Order
@@ -203,14 +313,11 @@ def order(order):
 	"""
 	Place an order with the service.
 	"""
-	auth_token, cluster_endpoint = get_nova()
+	client = workload_client.WorkloadClient()
 	config = json.loads(open("workload-generic.cfg").read())
 	print 
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		json.dumps({"order": [{"instances": int(order), "memory_mb": 4096}]}), {'Content-Type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "PUT"
-	response = urllib2.urlopen(request).read()
-	response_json = json.loads(response)
+	response_json = client.request("PUT", "/os-workloads/"+str(config['id']),
+		{"order": [{"instances": int(order), "flavor": config.get('flavor', DEFAULT_FLAVOR)}]}).body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 if __name__ == '__main__':
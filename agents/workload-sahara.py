@@ -17,7 +17,6 @@
 
 import json
 import argparse
-import urllib2
 import sys
 import os
 import re
@@ -27,8 +26,14 @@ import novaclient.v1_1
 import time
 import random
 import string
+import workload_client
 from saharaclient.api.client import Client as saharaclient
 
+# Seconds to wait for the cluster to become Active, before and after a scale.
+SCALE_TIMEOUT = 3600
+# Where each scale's time in every cluster state is recorded, as JSON lines.
+SCALE_LOG = "workload-sahara-scale.log"
+
 
 def get_sahara_cluster(name):
 	sahara = saharaclient(auth_url=os.getenv("OS_AUTH_URL"),
@@ -47,23 +52,6 @@ def get_sahara_cluster(name):
 		raise Exception("No cluster found with name " + name)
 
 
-def get_nova():
-
-	keystone = keystoneclient.v2_0.client.Client(username=os.getenv("OS_USERNAME"),
-							password=os.getenv("OS_PASSWORD"),
-							tenant_id=os.getenv("OS_TENANT_ID"),
-							auth_url=os.getenv("OS_AUTH_URL"))
-	
-	compute_catalog = keystone.service_catalog.get_endpoints()['computev21']
-	
-	cluster_endpoint = None
-	
-	for endpoint in compute_catalog:
-		if endpoint['region'] == os.getenv("OS_REGION_NAME"):
-			cluster_endpoint = endpoint
-
-	return (keystone.auth_token, cluster_endpoint)
-
 # Register Workload
 def register(workload, priority):
 	"""
@@ -71,17 +59,9 @@ def register(workload, priority):
 	"""
 	print "Registering "+workload
 
-	auth_token, cluster_endpoint = get_nova()
-
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads",
-		json.dumps({"workload":{"name":workload,"priority":priority}}), {'Content-type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "POST"
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-	
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("POST", "/os-workloads",
+		{"workload":{"name":workload,"priority":priority}}).body
 
 	config = open('workload-sahara.cfg', 'w')
 	workload = {"name":response_json['workload']['name'],"id":response_json['workload']['id']}
@@ -91,17 +71,8 @@ def register(workload, priority):
 
 
 def list_workloads():
-	auth_token, cluster_endpoint = get_nova()
-
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads",
-		None, {'X-Auth-Token':auth_token})
-
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-		
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("GET", "/os-workloads").body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 def delete():
@@ -109,121 +80,84 @@ def delete():
 	Delete a workload.
 	"""
 	config = json.loads(open("workload-sahara.cfg").read())
-	auth_token, cluster_endpoint = get_nova()
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		None, {'X-Auth-Token':auth_token})
-	request.get_method = lambda: "DELETE"
-	try:
-		response = urllib2.urlopen(request).read()
-	except urllib2.HTTPError, e:
-		raise StandardError("HTTP Error from workload service: "+str(e))
-		
-	response_json = json.loads(response)
+	client = workload_client.WorkloadClient()
+	response_json = client.request("DELETE", "/os-workloads/"+str(config['id'])).body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 def watch():
 	"""
+	Carry out this workload's orders until interrupted.
+	"""
+	config = json.loads(open("workload-sahara.cfg").read())
+	workload_client.watch(workload_client.WorkloadClient(), config, scale)
 
+def cluster_waiter(sahara, cluster_id):
 	"""
-	# Watch Workload
+	A StatusWaiter on a Sahara cluster that reports each state change.
+	"""
+	def status():
+		return sahara.clusters.get(cluster_id).status
 
-	config = json.loads(open("workload-sahara.cfg").read())
+	def transition(old, new, seconds):
+		print "Cluster %s after %.1fs, now %s" % (old, seconds, new)
 
-	auth_token, cluster_endpoint = get_nova()
-		
-	keystone_timeout = time.time()
-
-	while True:
-
-		if time.time() - keystone_timeout > 300:
-			auth_token, cluster_endpoint = get_nova()
-			keystone_timeout = time.time()
-
-		#  Watch for new orders
-		#try:
-		request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-			None, {'X-Auth-Token':auth_token})
-		response = urllib2.urlopen(request).read()
-		response_json = json.loads(response)
-		orders = response_json['orders']
-		#except:
-		#	orders = None
-
-		#  Execute orders (spin up instances, spin down instances)
-		if orders:
-			for order in orders:
-				print "New order: "+str(order['id'])
-				# We should update the order status to 'WORKING' eventually
-				if order['instances'] > 0:
-					create_instances(order['instances'],config)
-				if order['instances'] < 0:
-					delete_instances(order['instances']*-1,config)
-				acknowledge_order(config,order,auth_token,cluster_endpoint)
-
-		time.sleep(2)
-
-def acknowledge_order(config,order,auth_token, cluster_endpoint):
-	print "Acknowledging Order "+str(order['id'])
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		json.dumps({"order": [{"id": order['id'], "status": "FILLED"}]}), {'Content-Type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "PUT"
-	response = urllib2.urlopen(request).read()
-	return True
+	return workload_client.StatusWaiter(status, initial=2, maximum=30,
+		timeout=SCALE_TIMEOUT, on_transition=transition)
 
+def scale_cluster(scale,config):
+	"""
+	Resize the cluster's Data node group by scale and wait for it to
+	become Active again.
 
-def create_instances(scale,config):
+	Returns the number of nodes added (or, negative, removed), which is 0
+	if the scale failed. The seconds spent in each cluster state are
+	appended to the workload's scale log.
+	"""
 	sahara, cluster = get_sahara_cluster(config['name'])
-	print "Scaling up",scale
-	working_cluster = sahara.clusters.get(cluster.id)
-	while cluster.status != "Active":
-		print "Waiting for cluster to become active, currently: ",working_cluster.status
-		time.sleep(10)
-		working_cluster = sahara.clusters.get(cluster.id)
-
-	scale_object = dict()
-	for group in working_cluster.node_groups:
-		if group['name'] == "Data":
-			scale_object["resize_node_groups"] = [{"name": group['name'],
-                             "count": int(group['count'])+scale}]
-			print "Submitting scale request",scale_object
-			try:
-				sahara.clusters.scale(cluster.id, scale_object)
-			except Exception as e:
-				print "Failed Sahara request: ",e
-			time.sleep(10)
-	working_cluster = sahara.clusters.get(cluster.id)
-	while working_cluster.status != "Active":
-		print "Waiting for cluster to become active, currently: ",working_cluster.status
-		time.sleep(10)
-		working_cluster = sahara.clusters.get(cluster.id)
+	waiter = cluster_waiter(sahara, cluster.id)
+	started = time.time()
+	print "Scaling",scale
+	result = 0
+
+	try:
+		if waiter.wait(["Active", "Error"]) == "Active":
+			working_cluster = sahara.clusters.get(cluster.id)
+			scale_object = dict()
+			for group in working_cluster.node_groups:
+				if group['name'] == "Data":
+					scale_object["resize_node_groups"] = [{"name": group['name'],
+					                     "count": max(0, int(group['count'])+scale)}]
+					print "Submitting scale request",scale_object
+					sahara.clusters.scale(cluster.id, scale_object)
+					# Sahara has left Active by the time the request returns.
+					if waiter.wait(["Active", "Error"]) == "Active":
+						# Sahara may not have made the count asked for.
+						for scaled in sahara.clusters.get(cluster.id).node_groups:
+							if scaled['name'] == "Data":
+								result = int(scaled['count']) - int(group['count'])
+	except Exception as e:
+		print "Failed Sahara request: ",e
+
+	record = {"cluster": config['name'], "scale": scale, "result": result,
+	          "started": started, "seconds": time.time() - started,
+	          "states": waiter.durations}
+	print "Scale finished:", json.dumps(record, sort_keys=True)
+	log = open(config.get('scale_log', SCALE_LOG), 'a')
+	log.write(json.dumps(record) + "\n")
+	log.close()
+	return result
+
+def scale(net,config):
+	"""
+	Resize the cluster by net nodes; return the change actually made.
+	"""
+	return scale_cluster(net,config)
+
+def create_instances(scale,config):
+	return scale_cluster(scale,config)
 
 def delete_instances(scale,config):
-	sahara, cluster = get_sahara_cluster(config['name'])
-	scale_object = dict()
-	scale = scale * -1
-	print "Scaling down",scale
-	working_cluster = sahara.clusters.get(cluster.id)
-	while working_cluster.status != "Active":
-		print "Waiting for cluster to become active, currently: ",working_cluster.status
-		time.sleep(10)
-		working_cluster = sahara.clusters.get(cluster.id)
-
-	for group in working_cluster.node_groups:
-		if group['name'] == "Data":
-			scale_object["resize_node_groups"] = [{"name": group['name'],
-                             "count": int(group['count'])+scale}]
-			print "Submitting scale request",scale_object
-			try:
-				sahara.clusters.scale(cluster.id, scale_object)
-			except Exception as e:
-				print "Failed Sahara request: ",e
-				pass
-			time.sleep(10)
-	working_cluster = sahara.clusters.get(cluster.id)
-	while working_cluster.status != "Active":
-		print "Waiting for cluster to become active, currently: ",working_cluster.status
-		time.sleep(10)
-		working_cluster = sahara.clusters.get(cluster.id)
+	return scale_cluster(scale * -1,config)
 
 
 # Request Order
@@ -232,14 +166,11 @@ def order(order):
 	"""
 	Place an order with the service.
 	"""
-	auth_token, cluster_endpoint = get_nova()
+	client = workload_client.WorkloadClient()
 	config = json.loads(open("workload-sahara.cfg").read())
 	print 
-	request = urllib2.Request(cluster_endpoint["publicURL"]+"/os-workloads/"+str(config['id']),
-		json.dumps({"order": [{"instances": int(order), "memory_mb": 4096}]}), {'Content-Type':'application/json','X-Auth-Token':auth_token})
-	request.get_method = lambda: "PUT"
-	response = urllib2.urlopen(request).read()
-	response_json = json.loads(response)
+	response_json = client.request("PUT", "/os-workloads/"+str(config['id']),
+		{"order": [{"instances": int(order), "memory_mb": 4096}]}).body
 	print json.dumps(response_json, sort_keys=True, indent=4)
 
 if __name__ == '__main__':
@@ -0,0 +1,471 @@
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Shared os-workloads client for the agent scripts.
+
+Authenticates against keystone v2 once per token lifetime, keeping the
+token and compute endpoint on disk so one-shot commands don't re-authenticate,
+and sends every request over a pool of keep-alive connections.  GET and
+DELETE are retried with backoff when the service returns a 5xx or drops
+the connection; other requests only when they couldn't be sent at all,
+since a retried POST or PUT could register a workload or place an order
+twice.
+"""
+
+import calendar
+import hashlib
+import httplib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import keystoneclient.v2_0
+
+# Re-authenticate this many seconds before the token says it expires.
+REFRESH_MARGIN = 120
+# Attempts for a request that fails with a 5xx or a dropped connection.
+MAX_ATTEMPTS = 4
+# Methods that can safely be sent again after an unknown outcome.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
+# Seconds before the first retry; doubled for each one after.
+BACKOFF = 0.5
+# Seconds the workload service may hold a watch request open.
+LONG_POLL_WAIT = 30
+# Longest pause, in seconds, after repeated failures in a watch loop.
+MAX_WATCH_BACKOFF = 60
+
+TOKEN_CACHE = os.getenv("OS_WORKLOAD_TOKEN_CACHE",
+	os.path.expanduser("~/.workload-agent-tokens.json"))
+
+
+class WorkloadClientError(StandardError):
+	"""An os-workloads request failed with status code."""
+
+	def __init__(self, code, message):
+		StandardError.__init__(self, "HTTP Error from workload service: %s %s" % (code, message))
+		self.code = code
+
+
+class NotSent(StandardError):
+	"""A connection failed before any of the request went out."""
+
+
+class Response(object):
+
+	def __init__(self, status, headers, body):
+		self.status = status
+		self.headers = headers
+		self.body = body
+
+
+class FileCache(object):
+	"""
+	Entries carrying an "expires" time, kept in memory and in a JSON file
+	shared by every agent run.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.entries = {}
+
+	def _read(self):
+		try:
+			return json.loads(open(self.path).read())
+		except (IOError, ValueError):
+			return {}
+
+	def _write(self, entries):
+		now = time.time()
+		for key in entries.keys():
+			if entries[key]['expires'] < now:
+				del entries[key]
+		directory = os.path.dirname(os.path.abspath(self.path))
+		fd, tmp = tempfile.mkstemp(dir=directory)
+		try:
+			os.fchmod(fd, 0600)
+			os.write(fd, json.dumps(entries))
+		finally:
+			os.close(fd)
+		os.rename(tmp, self.path)
+
+	def get(self, key):
+		"""Return the unexpired entry for key, or None."""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				entry = self._read().get(key)
+			if entry is None or entry['expires'] < time.time():
+				return None
+			self.entries[key] = entry
+			return entry
+
+	def put(self, key, entry):
+		with self.lock:
+			self.entries[key] = entry
+			entries = self._read()
+			entries[key] = entry
+			self._write(entries)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+			entries = self._read()
+			if entries.pop(key, None) is not None:
+				self._write(entries)
+
+
+class TokenCache(FileCache):
+	"""
+	Keystone tokens, keyed by credentials and region.
+	"""
+
+	def __init__(self, path=TOKEN_CACHE):
+		FileCache.__init__(self, path)
+
+	def key(self, credentials):
+		return hashlib.sha1(json.dumps(credentials, sort_keys=True)).hexdigest()
+
+	def get(self, credentials):
+		return FileCache.get(self, self.key(credentials))
+
+	def put(self, credentials, entry):
+		FileCache.put(self, self.key(credentials), entry)
+
+
+def apportion(orders, achieved):
+	"""
+	Share the net change made for a batch of coalesced orders among them.
+
+	Orders against the net delta are met in full by cancelling out; those
+	along it are met in turn from what cancelled out plus achieved, the
+	change actually made. Returns {order id: instances filled}.
+	"""
+	net = sum(order['instances'] for order in orders)
+	sign = 1 if net >= 0 else -1
+	along = [order for order in orders if order['instances'] * sign > 0]
+	available = sum(order['instances'] for order in along) - net + achieved
+	filled = {}
+	for order in orders:
+		if order['instances'] * sign <= 0:
+			filled[order['id']] = order['instances']
+	for order in along:
+		share = sign * min(abs(order['instances']), max(0, available * sign))
+		filled[order['id']] = share
+		available -= share
+	return filled
+
+
+class WaitTimeout(StandardError):
+	pass
+
+
+class StatusWaiter(object):
+	"""
+	Polls get_status() until it reaches a target status.
+
+	The poll interval starts at initial seconds and doubles up to maximum
+	while nothing changes, dropping back to initial whenever the status
+	moves so the next move is seen quickly. on_transition(old, new,
+	seconds_in_old) is called on every change, and durations records the
+	seconds spent in each status across every wait().
+	"""
+
+	def __init__(self, get_status, initial=1, maximum=15, timeout=3600,
+	             on_transition=None):
+		self.get_status = get_status
+		self.initial = initial
+		self.maximum = maximum
+		self.timeout = timeout
+		self.on_transition = on_transition
+		self.durations = {}
+
+	def wait(self, targets):
+		"""
+		Return the first status in targets, or raise WaitTimeout.
+		"""
+		deadline = time.time() + self.timeout
+		delay = self.initial
+		status = self.get_status()
+		since = time.time()
+		while status not in targets:
+			if time.time() > deadline:
+				raise WaitTimeout("Still %s after %d seconds" % (status, self.timeout))
+			time.sleep(min(delay, max(0, deadline - time.time())))
+			current = self.get_status()
+			now = time.time()
+			if current != status:
+				self._record(status, now - since)
+				if self.on_transition:
+					self.on_transition(status, current, now - since)
+				status, since, delay = current, now, self.initial
+			else:
+				delay = min(delay * 2, self.maximum)
+		self._record(status, time.time() - since)
+		return status
+
+	def _record(self, status, seconds):
+		self.durations[status] = self.durations.get(status, 0) + seconds
+
+
+class WorkloadClient(object):
+	"""
+	Authenticated, pooled access to the os-workloads API.
+	"""
+
+	def __init__(self, token_cache=None):
+		self.credentials = {"username": os.getenv("OS_USERNAME"),
+		                    "tenant_id": os.getenv("OS_TENANT_ID"),
+		                    "auth_url": os.getenv("OS_AUTH_URL"),
+		                    "region": os.getenv("OS_REGION_NAME")}
+		self.token_cache = token_cache or TokenCache()
+		self.token = None
+		self.lock = threading.Lock()
+		self.idle = {}
+
+	def authenticate(self):
+		keystone = keystoneclient.v2_0.client.Client(username=self.credentials["username"],
+								password=os.getenv("OS_PASSWORD"),
+								tenant_id=self.credentials["tenant_id"],
+								auth_url=self.credentials["auth_url"])
+
+		compute_catalog = keystone.service_catalog.get_endpoints()['computev21']
+
+		cluster_endpoint = None
+
+		for endpoint in compute_catalog:
+			if endpoint['region'] == self.credentials["region"]:
+				cluster_endpoint = endpoint
+
+		expires = keystone.auth_ref.expires
+		return {"token": keystone.auth_token,
+		        "endpoint": cluster_endpoint["publicURL"],
+		        "expires": calendar.timegm(expires.utctimetuple())}
+
+	def get_token(self, force=False):
+		"""
+		Return a token and endpoint that won't expire within REFRESH_MARGIN.
+		"""
+		with self.lock:
+			now = time.time() + REFRESH_MARGIN
+			if not force and (self.token is None or self.token["expires"] < now):
+				self.token = self.token_cache.get(self.credentials)
+			if force or self.token is None or self.token["expires"] < now:
+				self.token = self.authenticate()
+				self.token_cache.put(self.credentials, self.token)
+			return self.token
+
+	def _connection(self, netloc, scheme, pooled=True):
+		with self.lock:
+			idle = self.idle.get(netloc)
+			if idle and pooled:
+				return idle.pop()
+		if scheme == "https":
+			return httplib.HTTPSConnection(netloc)
+		return httplib.HTTPConnection(netloc)
+
+	def _release(self, netloc, conn):
+		with self.lock:
+			self.idle.setdefault(netloc, []).append(conn)
+
+	def _send(self, method, url, body, headers, timeout):
+		parts = urlparse.urlsplit(url)
+		path = parts.path
+		if parts.query:
+			path += "?" + parts.query
+		# A pooled connection the server has since closed can fail after
+		# the request went out, so requests we can't repeat get a new one.
+		conn = self._connection(parts.netloc, parts.scheme,
+			pooled=method in IDEMPOTENT_METHODS)
+		conn.timeout = timeout
+		if conn.sock:
+			conn.sock.settimeout(timeout)
+		else:
+			try:
+				conn.connect()
+			except (socket.error, httplib.HTTPException), e:
+				conn.close()
+				raise NotSent(str(e))
+		try:
+			conn.request(method, path, body, headers)
+			response = conn.getresponse()
+			data = response.read()
+		except:
+			conn.close()
+			raise
+		if response.getheader("connection", "").lower() == "close":
+			conn.close()
+		else:
+			self._release(parts.netloc, conn)
+		return response.status, dict(response.getheaders()), data
+
+	def request(self, method, path, body=None, headers=None, timeout=60):
+		"""
+		Send a request to the os-workloads endpoint and return a Response.
+
+		path is relative to the compute endpoint, for example
+		"/os-workloads/3".  A body is sent as JSON.  2xx and 304 responses
+		are returned; anything else raises WorkloadClientError.  Only
+		IDEMPOTENT_METHODS are retried once the request may have reached
+		the service.
+		"""
+		if body is not None:
+			body = json.dumps(body)
+		reauthenticated = False
+		attempt = 0
+		while True:
+			attempt += 1
+			token = self.get_token()
+			request_headers = {"X-Auth-Token": token["token"],
+			                   "Accept": "application/json"}
+			if body is not None:
+				request_headers["Content-Type"] = "application/json"
+			request_headers.update(headers or {})
+			try:
+				status, response_headers, data = self._send(method,
+					token["endpoint"] + path, body, request_headers, timeout)
+			except (NotSent, socket.error, httplib.HTTPException), e:
+				if attempt >= MAX_ATTEMPTS or not (isinstance(e, NotSent) or
+						method in IDEMPOTENT_METHODS):
+					raise WorkloadClientError(None, str(e))
+				# A pooled connection the server already closed fails at
+				# once; only back off if a fresh one fails too.
+				if attempt > 1:
+					time.sleep(BACKOFF * 2 ** (attempt - 2))
+				continue
+
+			if status == 401 and not reauthenticated:
+				self.get_token(force=True)
+				reauthenticated = True
+				continue
+			if status >= 500 and attempt < MAX_ATTEMPTS and \
+					method in IDEMPOTENT_METHODS:
+				time.sleep(BACKOFF * 2 ** (attempt - 1))
+				continue
+			if status >= 400:
+				raise WorkloadClientError(status, data)
+
+			return Response(status, response_headers,
+				json.loads(data) if data else None)
+
+	def start(self, workload_id, orders):
+		"""
+		Mark a batch of orders WORKING before carrying them out.
+
+		This releases the quota the service reserved for grow orders when
+		it opened them, so the servers we are about to boot can use it.
+		"""
+		return self.request("PUT", "/os-workloads/"+str(workload_id),
+			{"order": [{"id": order['id'], "status": "WORKING"} for order in orders]})
+
+	def acknowledge(self, workload_id, orders, filled=None):
+		"""
+		Acknowledge a batch of orders in a single request.
+
+		filled maps an order id to the instances actually added (or,
+		negative, removed) for it; a partly filled order is marked FILLED
+		for that many and one where nothing happened is marked ERROR.
+		"""
+		acks = []
+		for order in orders:
+			ack = {"id": order['id'], "status": "FILLED"}
+			done = (filled or {}).get(order['id'], order['instances'])
+			if done == 0:
+				ack["status"] = "ERROR"
+			elif done != order['instances']:
+				ack["instances"] = done
+			acks.append(ack)
+		return self.request("PUT", "/os-workloads/"+str(workload_id), {"order": acks})
+
+
+def say(message, prefix=""):
+	sys.stdout.write(prefix + message + "\n")
+
+
+def watch(client, config, scale, stop=None, prefix=""):
+	"""
+	Carry out a workload's orders as the service hands them out.
+
+	Long-polls the workload until its open orders change, coalesces each
+	batch into one net delta, calls scale(net, config) to make it, which
+	returns the change actually made, and acknowledges the batch; if
+	scale() raises, the batch is acknowledged as ERROR.  Runs
+	until the threading.Event stop is set; errors are reported and retried
+	with backoff, from a fresh read of the open orders, rather than
+	ending the loop.
+	"""
+	version = None
+	etag = None
+	failures = 0
+
+	while not (stop and stop.is_set()):
+
+		try:
+			#  Watch for new orders
+			#  The service holds the request until our open orders change
+			#  or LONG_POLL_WAIT passes.
+			path = "/os-workloads/"+str(config['id'])+"?wait="+str(LONG_POLL_WAIT)
+			if version:
+				path += "&since="+version
+			headers = {}
+			if etag:
+				headers['If-None-Match'] = etag
+			response = client.request("GET", path, headers=headers, timeout=LONG_POLL_WAIT+30)
+			if response.status == 304:
+				#  Nothing has changed since the last orders we were sent.
+				orders = None
+			else:
+				etag = response.headers.get('etag')
+				orders = response.body['orders']
+				version = response.body.get('version')
+
+			#  Execute orders (spin up instances, spin down instances)
+			if orders:
+				#  Coalesce everything we were sent into one net scale
+				#  operation, rather than booting and deleting in turn.
+				net = sum(order['instances'] for order in orders)
+				say("New orders: "+", ".join(str(order['id']) for order in orders)+" (net %+d)" % net, prefix)
+				client.start(config['id'], orders)
+				try:
+					achieved = scale(net, config) if net else 0
+				except Exception:
+					#  Don't leave the batch WORKING, where nobody will
+					#  hand it to us again.
+					client.acknowledge(config['id'], orders,
+						dict((order['id'], 0) for order in orders))
+					raise
+				say("Acknowledging Orders "+", ".join(str(order['id']) for order in orders), prefix)
+				client.acknowledge(config['id'], orders, apportion(orders, achieved))
+			failures = 0
+		except Exception as e:
+			failures += 1
+			say("Watch failed: "+str(e), prefix)
+			#  The batch may not have been started or acknowledged, so
+			#  ask for every open order again rather than waiting for
+			#  the workload to change.
+			version = None
+			etag = None
+			time.sleep(min(BACKOFF * 2 ** failures, MAX_WATCH_BACKOFF))
+			continue
+
+		if not version:
+			# The service doesn't support long-polling, so don't hammer it.
+			time.sleep(2)
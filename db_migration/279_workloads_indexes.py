@@ -0,0 +1,88 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+from migrate import ForeignKeyConstraint
+import sqlalchemy as sa
+
+# oslo.log's loggers are the standard library's underneath, and the plain
+# module keeps tools/check_query_plans.py runnable without nova.
+LOG = logging.getLogger(__name__)
+
+# (table, index name, columns) for every lookup the workloads API makes:
+# listing a project's workloads by priority, reading a workload's OPEN /
+# PENDING orders, and joining a project's PENDING orders to workloads.
+INDEXES = [
+    ('workloads', 'workloads_project_id_deleted_priority_idx',
+        ['project_id', 'deleted', 'priority']),
+    ('workload_orders', 'workload_orders_workload_id_status_deleted_idx',
+        ['workload_id', 'status', 'deleted']),
+    ('workload_orders', 'workload_orders_status_deleted_workload_id_idx',
+        ['status', 'deleted', 'workload_id']),
+]
+
+FKEY_NAME = 'workload_orders_workload_id_fkey'
+UNIQUE_NAME = 'uniq_workloads0id'
+
+
+def _fkey(workloads, workloadorders):
+    return ForeignKeyConstraint(columns=[workloadorders.c.workload_id],
+                                refcolumns=[workloads.c.id],
+                                name=FKEY_NAME)
+
+
+def upgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloads = sa.Table('workloads', meta, autoload=True)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+
+    # The primary key is (id, project_id); a foreign key needs id on its own
+    # to be unique.
+    sa.Index(UNIQUE_NAME, workloads.c.id, unique=True).create(migrate_engine)
+
+    for table_name, index_name, columns in INDEXES:
+        table = sa.Table(table_name, meta, autoload=True)
+        sa.Index(index_name, *[table.c[c] for c in columns]).create(
+            migrate_engine)
+
+    # SQLite has no ALTER TABLE ... ADD CONSTRAINT; the indexes are all the
+    # test databases need.
+    if migrate_engine.name == 'sqlite':
+        return
+
+    # Orders whose workload row is gone can never be read back through the
+    # API and would block the constraint.
+    orphans = workloadorders.delete().where(
+        ~workloadorders.c.workload_id.in_(sa.select([workloads.c.id])))
+    removed = migrate_engine.execute(orphans).rowcount
+    if removed:
+        LOG.warning("Deleted %d workload_orders rows whose workload no "
+                    "longer exists", removed)
+
+    _fkey(workloads, workloadorders).create()
+
+
+def downgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloads = sa.Table('workloads', meta, autoload=True)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+
+    if migrate_engine.name != 'sqlite':
+        _fkey(workloads, workloadorders).drop()
+
+    for table_name, index_name, columns in INDEXES:
+        table = sa.Table(table_name, meta, autoload=True)
+        sa.Index(index_name, *[table.c[c] for c in columns]).drop(
+            migrate_engine)
+
+    sa.Index(UNIQUE_NAME, workloads.c.id, unique=True).drop(migrate_engine)
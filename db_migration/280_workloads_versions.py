@@ -0,0 +1,43 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import migrate  # noqa: adds Table.create_column()/drop_column()
+import sqlalchemy as sa
+
+
+def upgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+
+    workloads = sa.Table('workloads', meta, autoload=True)
+    workloads.create_column(sa.Column('version', sa.Integer, nullable=False,
+                                      server_default='0'))
+
+    workloadprojects = sa.Table('workload_projects', meta,
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('updated_at', sa.DateTime),
+        sa.Column('deleted_at', sa.DateTime),
+        sa.Column('deleted', sa.Integer, default=0),
+        sa.Column('project_id', sa.String(length=255), primary_key=True,
+                  nullable=False),
+        sa.Column('version', sa.Integer, nullable=False, server_default='0'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+        )
+    workloadprojects.create()
+
+
+def downgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloads = sa.Table('workloads', meta, autoload=True)
+    workloads.drop_column('version')
+    table = sa.Table('workload_projects', meta, autoload=True)
+    table.drop()
@@ -0,0 +1,48 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from migrate import ForeignKeyConstraint
+import sqlalchemy as sa
+
+INDEX_NAME = 'workload_orders_serves_order_id_idx'
+FKEY_NAME = 'workload_orders_serves_order_id_fkey'
+
+
+def _fkey(workloadorders):
+    return ForeignKeyConstraint(columns=[workloadorders.c.serves_order_id],
+                                refcolumns=[workloadorders.c.id],
+                                name=FKEY_NAME)
+
+
+def upgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+
+    # The pending order a preemption scale-down frees capacity for.
+    workloadorders.create_column(sa.Column('serves_order_id', sa.Integer))
+    sa.Index(INDEX_NAME, workloadorders.c.serves_order_id).create(
+        migrate_engine)
+
+    # SQLite has no ALTER TABLE ... ADD CONSTRAINT.
+    if migrate_engine.name != 'sqlite':
+        _fkey(workloadorders).create()
+
+
+def downgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+
+    if migrate_engine.name != 'sqlite':
+        _fkey(workloadorders).drop()
+    sa.Index(INDEX_NAME, workloadorders.c.serves_order_id).drop(
+        migrate_engine)
+    workloadorders.drop_column('serves_order_id')
@@ -0,0 +1,29 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import migrate  # noqa: adds Table.create_column()/drop_column()
+import sqlalchemy as sa
+
+
+def upgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+    # Compare-and-swap counter for order changes.
+    workloadorders.create_column(sa.Column('version', sa.Integer,
+                                           nullable=False,
+                                           server_default='0'))
+
+
+def downgrade(migrate_engine):
+    meta = sa.MetaData(bind=migrate_engine)
+    workloadorders = sa.Table('workload_orders', meta, autoload=True)
+    workloadorders.drop_column('version')
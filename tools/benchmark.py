@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark the workloads API handlers without a cloud.
+
+Loads workloads.py into a nova source tree's environment, points it at an
+in-memory SQLite database holding the instances, workloads and
+workload_orders tables, swaps nova's quota engine for a fake one, seeds
+it and times index(), show(), update() and update_pending_orders().
+Reports p50/p95/p99 latency, SQL statements, quota reads and quota
+reservations per call.
+
+    tools/benchmark.py
+    tools/benchmark.py --workloads 1000 --instances 100000 --orders 50000
+    tools/benchmark.py --json > before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import random
+import sys
+import threading
+import timeit
+import uuid
+
+from oslo_config import cfg
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'workloads.py')
+CONF = cfg.CONF
+
+
+class FakeQuotas(object):
+    """
+    Stands in for nova.quota.QUOTAS.
+
+    Every project is limited to its seeded instances plus headroom, so
+    some grow orders open and the rest stay PENDING.  Reservations are
+    held in memory.
+    """
+
+    def __init__(self, in_use, headroom):
+        self.in_use = in_use
+        self.headroom = headroom
+        self.calls = 0
+        self.reserves = 0
+        self.lock = threading.Lock()
+        self.reservations = {}
+
+    def usage(self, context, project_id):
+        instances, ram = self.in_use.get(project_id, (0, 0))
+        return {'instances': instances, 'ram': ram}
+
+    def limits(self, project_id):
+        instances, ram = self.in_use.get(project_id, (0, 0))
+        return {'instances': instances + self.headroom,
+                'ram': ram + self.headroom * 4096}
+
+    def _quotas(self, context, project_id):
+        in_use = self.usage(context, project_id)
+        reserved = dict((resource, 0) for resource in in_use)
+        for owner, deltas in self.reservations.values():
+            if owner == project_id:
+                for resource, delta in deltas.items():
+                    reserved[resource] = reserved.get(resource, 0) + delta
+        return dict((resource, {'limit': limit,
+                                'in_use': in_use.get(resource, 0),
+                                'reserved': reserved.get(resource, 0)})
+                    for resource, limit in self.limits(project_id).items())
+
+    def get_project_quotas(self, context, project_id, **kwargs):
+        self.calls += 1
+        with self.lock:
+            return self._quotas(context, project_id)
+
+    def reserve(self, context, expire=None, project_id=None, user_id=None,
+                **deltas):
+        from nova import exception
+
+        with self.lock:
+            self.reserves += 1
+            quotas = self._quotas(context, project_id)
+            overs = [resource for resource, delta in deltas.items()
+                     if resource in quotas and quotas[resource]['limit'] >= 0
+                     and quotas[resource]['in_use'] +
+                     quotas[resource]['reserved'] + delta >
+                     quotas[resource]['limit']]
+            if overs:
+                raise exception.OverQuota(overs=overs, quotas={},
+                                          usages={})
+            reservation = str(uuid.uuid4())
+            self.reservations[reservation] = (project_id, deltas)
+            return [reservation]
+
+    def rollback(self, context, reservations, project_id=None,
+                 user_id=None):
+        with self.lock:
+            for reservation in reservations:
+                self.reservations.pop(reservation, None)
+
+
+def setup(quota_cache_ttl, connection='sqlite://'):
+    """Configure nova for a scratch database and load the plugin."""
+    from nova import config
+    from nova import rpc
+
+    config.parse_args([], default_config_files=[])
+    CONF.set_override('connection', connection, group='database')
+    # The controller builds a compute API, which wants an RPC transport.
+    CONF.set_override('rpc_backend', 'fake')
+    rpc.init(CONF)
+
+    workloads = imp.load_source('workloads', PLUGIN)
+    CONF.set_override('quota_cache_ttl', quota_cache_ttl, group='workloads')
+    # Policy is not what we're measuring.
+    workloads.authorize = lambda context, action=None: None
+    return workloads
+
+
+def create_tables(workloads):
+    """
+    Create the instances and flavor tables and the plugin's tables; return
+    the engine.
+    """
+    from nova.db.sqlalchemy import api as db_api
+    from nova.db.sqlalchemy import models
+
+    engine = db_api.get_engine()
+    models.Instance.__table__.create(engine)
+    # New orders are sized from a flavor unless they give memory_mb and
+    # vcpus.
+    for model in (models.InstanceTypes, models.InstanceTypeProjects,
+                  models.InstanceTypeExtraSpecs):
+        model.__table__.create(engine)
+    workloads.BASE.metadata.create_all(engine)
+    return engine
+
+
+def seed(workloads, args):
+    """
+    Create args.projects projects sharing args.workloads workloads,
+    args.instances instances and args.orders orders between them.
+    Returns ({project_id: (instances, memory_mb) in use}, workload rows).
+    """
+    from nova.db.sqlalchemy import models
+
+    engine = create_tables(workloads)
+
+    workload_rows = []
+    for n in range(args.workloads):
+        workload_rows.append({'id': n + 1,
+                              'project_id': 'project-%d' % (n % args.projects),
+                              'name': 'workload-%d' % (n + 1),
+                              'priority': random.randint(1, 10),
+                              'deleted': '',
+                              'version': 0})
+    engine.execute(workloads.Workload.__table__.insert(), workload_rows)
+
+    in_use = {}
+    instance_rows = []
+    for n in range(args.instances):
+        workload = workload_rows[n % args.workloads]
+        memory_mb = random.choice([1024, 2048, 4096])
+        instance_rows.append({'uuid': str(uuid.uuid4()),
+                              'project_id': workload['project_id'],
+                              'display_name': '%s-%d' % (workload['name'], n),
+                              'memory_mb': memory_mb,
+                              'vm_state': 'active',
+                              'deleted': 0})
+        instances, ram = in_use.get(workload['project_id'], (0, 0))
+        in_use[workload['project_id']] = (instances + 1, ram + memory_mb)
+    engine.execute(models.Instance.__table__.insert(), instance_rows)
+
+    order_rows = []
+    for n in range(args.orders):
+        order_rows.append({'workload_id': random.randint(1, args.workloads),
+                           'instances': random.randint(-5, 5) or 1,
+                           'memory_mb': 4096,
+                           'status': random.choice(
+                               ['FILLED'] * 18 + ['OPEN', 'PENDING']),
+                           'deleted': 0})
+    engine.execute(workloads.WorkloadOrder.__table__.insert(), order_rows)
+    engine.execute('ANALYZE')
+    return in_use, workload_rows
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a sorted list."""
+    return samples[max(0, int(round(p / 100.0 * len(samples))) - 1)]
+
+
+class Bench(object):
+    """Runs calls and collects latency, SQL and quota read counts."""
+
+    def __init__(self, workloads, quotas):
+        self.workloads = workloads
+        self.quotas = quotas
+        self.samples = {}
+
+    def measure(self, name, call, *args):
+        queries = self.workloads.QUERY_COUNTER.count
+        quota_calls = self.quotas.calls
+        reserves = self.quotas.reserves
+        start = timeit.default_timer()
+        result = call(*args)
+        elapsed = timeit.default_timer() - start
+        self.samples.setdefault(name, []).append(
+            (elapsed, self.workloads.QUERY_COUNTER.count - queries,
+             self.quotas.calls - quota_calls,
+             self.quotas.reserves - reserves))
+        return result
+
+    def report(self):
+        results = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = sorted(sample[0] * 1000 for sample in samples)
+            results[name] = {
+                'calls': len(samples),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'sql_per_call': float(sum(s[1] for s in samples)) /
+                len(samples),
+                'quota_reads_per_call': float(sum(s[2] for s in samples)) /
+                len(samples),
+                'reserves_per_call': float(sum(s[3] for s in samples)) /
+                len(samples),
+            }
+        return results
+
+
+def run(workloads, bench, workload_rows, iterations):
+    from nova.api.openstack import wsgi
+    from nova import context as nova_context
+
+    controller = workloads.WorkloadsController()
+    reconciler = workloads.WorkloadReconciler()
+    projects = sorted(set(row['project_id'] for row in workload_rows))
+
+    def request(project_id, path):
+        req = wsgi.Request.blank(path)
+        req.environ['nova.context'] = nova_context.RequestContext(
+            'bench', project_id)
+        return req
+
+    def index(req):
+        # index() streams its body, so encoding it is part of the call.
+        return b''.join(controller.index(req).app_iter)
+
+    for i in range(iterations):
+        row = random.choice(workload_rows)
+        project_id = row['project_id']
+        url = '/v2.1/%s/os-workloads' % project_id
+
+        bench.measure('index', index, request(project_id, url))
+        bench.measure('show', controller.show,
+                      request(project_id, '%s/%d' % (url, row['id'])),
+                      row['id'])
+
+        req = request(project_id, '%s/%d' % (url, row['id']))
+        placed = bench.measure('update (order)', controller.update, req,
+                               row['id'], {'order': [{'instances': 1,
+                                                      'memory_mb': 2048,
+                                                      'vcpus': 1}]})
+        filled = [{'id': order.id, 'status': 'FILLED'}
+                  for order in placed['order']]
+        if filled:
+            bench.measure('update (fill)', controller.update, req,
+                          row['id'], {'order': filled})
+
+        bench.measure('update_pending_orders',
+                      reconciler.update_pending_orders,
+                      nova_context.get_admin_context(),
+                      projects[i % len(projects)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--workloads', type=int, default=1000)
+    parser.add_argument('--instances', type=int, default=100000)
+    parser.add_argument('--orders', type=int, default=50000,
+                        help='historical orders, mostly FILLED')
+    parser.add_argument('--headroom', type=int, default=20,
+                        help='instances each project may grow by')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--quota-cache-ttl', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workloads = setup(args.quota_cache_ttl)
+    in_use, workload_rows = seed(workloads, args)
+    quotas = FakeQuotas(in_use, args.headroom)
+    workloads.QUOTAS = quotas
+
+    bench = Bench(workloads, quotas)
+    run(workloads, bench, workload_rows, args.iterations)
+    results = bench.report()
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+    print('%-24s %7s %9s %9s %9s %9s %9s %9s' % (
+        'endpoint', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'sql', 'quota',
+        'reserves'))
+    for name, result in sorted(results.items()):
+        print('%-24s %7d %9.2f %9.2f %9.2f %9.1f %9.2f %9.2f' % (
+            name, result['calls'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['sql_per_call'],
+            result['quota_reads_per_call'], result['reserves_per_call']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
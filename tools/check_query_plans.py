@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Check that the workloads API queries are served from indexes.
+
+Runs the db_migration scripts against a scratch database, seeds it, and
+explains the statements index(), show(), update() and the reconciler
+issue.
+Exits non-zero if any of them falls back to a full table scan.
+
+    tools/check_query_plans.py
+    tools/check_query_plans.py --url mysql+pymysql://user:pw@host/scratch
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import glob
+import imp
+import os
+import random
+import re
+import sys
+
+import sqlalchemy as sa
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'db_migration')
+TABLES = ('workloads', 'workload_orders')
+PROJECT = 'project-0'
+
+
+def migrate(engine):
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS, '[0-9]*.py'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        imp.load_source('workloads_migration_' + name, path).upgrade(engine)
+
+
+def seed(engine, meta, workloads_per_project, orders_per_workload):
+    workloads = meta.tables['workloads']
+    orders = meta.tables['workload_orders']
+    workload_rows = []
+    order_rows = []
+    workload_id = 0
+    for project in range(10):
+        for n in range(workloads_per_project):
+            workload_id += 1
+            workload_rows.append({'id': workload_id,
+                                  'project_id': 'project-%d' % project,
+                                  'name': 'workload-%d' % workload_id,
+                                  'priority': random.randint(1, 10),
+                                  'deleted': ''})
+            for o in range(orders_per_workload):
+                order_rows.append({'workload_id': workload_id,
+                                   'instances': random.randint(-5, 5) or 1,
+                                   'memory_mb': 4096,
+                                   'status': random.choice(
+                                       ['FILLED'] * 8 + ['OPEN', 'PENDING']),
+                                   'deleted': '0'})
+    engine.execute(workloads.insert(), workload_rows)
+    engine.execute(orders.insert(), order_rows)
+    if engine.name == 'sqlite':
+        engine.execute('ANALYZE')
+    else:
+        engine.execute('ANALYZE TABLE workloads, workload_orders')
+
+
+def statements(meta):
+    """
+    The statements each endpoint and reconciler step issues, as
+    workloads.py builds them.
+    """
+    w = meta.tables['workloads']
+    o = meta.tables['workload_orders']
+    live_workload = sa.and_(w.c.deleted == '', w.c.project_id == PROJECT)
+    workload = sa.select([w]).where(sa.and_(live_workload, w.c.id == 1))
+    cutoff = datetime.datetime(2015, 1, 1)
+    pending = sa.select([o]).select_from(o.join(w, w.c.id == o.c.workload_id)).\
+        where(sa.and_(o.c.deleted == 0, o.c.status == 'PENDING',
+                      live_workload))
+
+    return {
+        'index': [
+            sa.select([w]).where(sa.and_(live_workload, w.c.id > 100)).
+            order_by(w.c.id).limit(50),
+        ],
+        'show': [
+            workload,
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.workload_id == 1,
+                o.c.status == 'OPEN')),
+        ],
+        'update': [
+            workload,
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.workload_id == 1,
+                o.c.id.in_([1, 2]))),
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.workload_id == 1,
+                sa.or_(o.c.status == 'PENDING', o.c.status == 'OPEN'),
+                o.c.instances >= 1)),
+        ],
+        'pending_projects': [
+            sa.select([o.c.workload_id]).distinct().where(sa.and_(
+                o.c.deleted == 0, o.c.status == 'PENDING')),
+            sa.select([w.c.project_id]).distinct().where(sa.and_(
+                w.c.deleted == '', w.c.id.in_([1, 2]))),
+        ],
+        'update_pending_orders': [
+            pending.order_by(w.c.priority),
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.id.in_([1, 2]),
+                o.c.status == 'PENDING')),
+        ],
+        'expire_reservations': [
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.status == 'OPEN',
+                o.c.reservations != None,  # noqa
+                o.c.opened_at < cutoff)),
+            sa.select([w.c.id, w.c.project_id]).where(w.c.id.in_([1, 2])),
+        ],
+        'expire_working': [
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.status == 'WORKING',
+                o.c.working_at < cutoff)),
+        ],
+        'expire_scale_downs': [
+            sa.select([o]).where(sa.and_(
+                o.c.deleted == 0, o.c.status == 'OPEN',
+                o.c.opened_at < cutoff, o.c.instances < 0)),
+        ],
+        'preempt': [
+            pending.where(o.c.instances > 0).order_by(w.c.priority),
+            sa.select([w]).where(live_workload),
+            sa.select([o]).select_from(o.join(w, w.c.id == o.c.workload_id)).
+            where(sa.and_(o.c.deleted == 0,
+                          sa.or_(o.c.status == 'OPEN',
+                                 o.c.status == 'WORKING'),
+                          o.c.instances < 0, live_workload)),
+        ],
+    }
+
+
+def full_scans(engine, statement):
+    """Return (plan lines, tables read without an index)."""
+    compiled = statement.compile(dialect=engine.dialect,
+                                 compile_kwargs={'literal_binds': True})
+    if engine.name == 'sqlite':
+        rows = engine.execute('EXPLAIN QUERY PLAN %s' % compiled).fetchall()
+        plan = [row[-1] for row in rows]
+        scans = [m.group(2) for m in
+                 (re.match(r'SCAN (TABLE )?(\w+)', line) for line in plan)
+                 if m and m.group(2) in TABLES]
+    else:
+        rows = engine.execute('EXPLAIN %s' % compiled).fetchall()
+        plan = ['%s: type=%s key=%s' % (row['table'], row['type'], row['key'])
+                for row in rows]
+        scans = [row['table'] for row in rows
+                 if row['table'] in TABLES and
+                 (row['type'] == 'ALL' or row['key'] is None)]
+    return plan, scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='sqlite://',
+                        help='scratch database (default: in-memory SQLite)')
+    parser.add_argument('--workloads', type=int, default=200,
+                        help='workloads per project')
+    parser.add_argument('--orders', type=int, default=20,
+                        help='orders per workload')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.url)
+    migrate(engine)
+    meta = sa.MetaData(bind=engine)
+    meta.reflect(only=TABLES)
+    seed(engine, meta, args.workloads, args.orders)
+
+    failed = False
+    for endpoint, queries in sorted(statements(meta).items()):
+        for statement in queries:
+            plan, scans = full_scans(engine, statement)
+            print('%s:\n    %s' % (endpoint, '\n    '.join(plan)))
+            if scans:
+                failed = True
+                print('    FULL SCAN of %s' % ', '.join(scans))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Check the reconciler against scenarios that have gone wrong before.
+
+Loads workloads.py into a nova source tree's environment the way
+tools/benchmark.py does, with an in-memory database and fake quotas,
+sets up each scenario in a project of its own, runs a reconciler pass
+over it and exits non-zero if any scenario ends up in the wrong state.
+
+    tools/check_reconciler.py
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import sys
+import uuid
+
+import benchmark
+
+
+class Scenario(object):
+    """A project set up in the scratch database, and what to expect of it."""
+
+    def __init__(self, workloads, engine, quotas, project_id, first_id):
+        self.workloads = workloads
+        self.engine = engine
+        self.quotas = quotas
+        self.project_id = project_id
+        self.next_id = first_id
+
+    def workload(self, priority, instances=0, memory_mb=2048, vcpus=1):
+        """Add a workload running instances servers; return its id."""
+        from nova.db.sqlalchemy import models
+
+        workload_id = self.next_id
+        self.next_id += 1
+        name = 'workload-%d' % workload_id
+        self.engine.execute(self.workloads.Workload.__table__.insert(), {
+            'id': workload_id, 'project_id': self.project_id, 'name': name,
+            'priority': priority, 'deleted': '', 'version': 0})
+        if instances:
+            self.engine.execute(models.Instance.__table__.insert(), [
+                {'uuid': str(uuid.uuid4()), 'project_id': self.project_id,
+                 'display_name': '%s-%d' % (name, n),
+                 'memory_mb': memory_mb, 'vcpus': vcpus,
+                 'vm_state': 'active', 'deleted': 0}
+                for n in range(instances)])
+        in_use, ram = self.quotas.in_use.get(self.project_id, (0, 0))
+        self.quotas.in_use[self.project_id] = (in_use + instances,
+                                               ram + instances * memory_mb)
+        return workload_id
+
+    def order(self, workload_id, instances, status, memory_mb=2048, vcpus=1,
+              **columns):
+        """Add an order; return its id."""
+        row = {'workload_id': workload_id, 'instances': instances,
+               'memory_mb': memory_mb, 'vcpus': vcpus, 'status': status,
+               'deleted': 0, 'version': 0}
+        row.update(columns)
+        return self.engine.execute(
+            self.workloads.WorkloadOrder.__table__.insert(),
+            row).inserted_primary_key[0]
+
+    def orders(self, **filters):
+        """Orders matching filters, as row dicts."""
+        table = self.workloads.WorkloadOrder.__table__
+        query = table.select()
+        for column, value in filters.items():
+            query = query.where(table.c[column] == value)
+        return [dict(row) for row in self.engine.execute(query)]
+
+    def reconcile(self):
+        from nova import context as nova_context
+
+        self.workloads.WorkloadReconciler().reconcile(
+            nova_context.get_admin_context())
+
+
+def reclaimed_capacity_taken(scenario):
+    """
+    A filled scale-down freed room for the high priority order, but a
+    lower priority order took it first.  The order must be preempted for
+    again rather than left PENDING for good.
+    """
+    high = scenario.workload(priority=1)
+    low = scenario.workload(priority=5, instances=4)
+    urgent = scenario.order(high, 2, 'PENDING')
+    scenario.order(low, -2, 'FILLED', serves_order_id=urgent)
+
+    scenario.reconcile()
+
+    scale_downs = scenario.orders(serves_order_id=urgent, status='OPEN')
+    if [order['instances'] for order in scale_downs] != [-2]:
+        return 'expected one new scale-down of 2, got %s' % scale_downs
+
+
+def agent_died_working(scenario):
+    """
+    The agent carrying out a scale-down died after marking it WORKING.
+    The order must be marked ERROR and stop being credited to the order
+    it served, which is preempted for again.
+    """
+    high = scenario.workload(priority=1)
+    low = scenario.workload(priority=5, instances=4)
+    urgent = scenario.order(high, 2, 'PENDING')
+    stuck = scenario.order(
+        low, -2, 'WORKING', serves_order_id=urgent,
+        working_at=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+
+    scenario.reconcile()
+
+    if scenario.orders(id=stuck)[0]['status'] != 'ERROR':
+        return 'expected the WORKING order to be marked ERROR'
+    scale_downs = scenario.orders(serves_order_id=urgent, status='OPEN')
+    if [order['instances'] for order in scale_downs] != [-2]:
+        return 'expected one new scale-down of 2, got %s' % scale_downs
+
+
+def scale_down_never_taken(scenario):
+    """
+    No agent ever started on a scale-down.  The order must be marked
+    ERROR and stop being credited to the order it served, which is
+    preempted for again.
+    """
+    high = scenario.workload(priority=1)
+    low = scenario.workload(priority=5, instances=4)
+    urgent = scenario.order(high, 2, 'PENDING')
+    stale = scenario.order(
+        low, -2, 'OPEN', serves_order_id=urgent,
+        opened_at=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+
+    scenario.reconcile()
+
+    if scenario.orders(id=stale)[0]['status'] != 'ERROR':
+        return 'expected the stale scale-down to be marked ERROR'
+    scale_downs = scenario.orders(serves_order_id=urgent, status='OPEN')
+    if [order['instances'] for order in scale_downs] != [-2]:
+        return 'expected one new scale-down of 2, got %s' % scale_downs
+
+
+SCENARIOS = [reclaimed_capacity_taken, agent_died_working,
+             scale_down_never_taken]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.parse_args()
+
+    workloads = benchmark.setup(quota_cache_ttl=0)
+    engine = benchmark.create_tables(workloads)
+    # Every project may run just the instances it starts with.
+    quotas = benchmark.FakeQuotas({}, 0)
+    workloads.QUOTAS = quotas
+
+    failed = False
+    for n, check in enumerate(SCENARIOS):
+        scenario = Scenario(workloads, engine, quotas, 'project-%d' % n,
+                            first_id=100 * n + 1)
+        error = check(scenario)
+        print('%s: %s' % (check.__name__, error or 'ok'))
+        failed = failed or bool(error)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
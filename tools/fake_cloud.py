@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+
+# Copyright 2015 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A local stand-in for keystone, nova and sahara to run the agents against.
+
+Serves a keystone v2 token and catalog, the os-workloads API through the
+real WorkloadsController and reconciler, server boot/list/delete with
+images and flavors, and sahara cluster scaling, each with configurable
+latency.  Servers and cluster nodes are rows in the instances table, so
+workload listings and quota usage follow what the agents do.  Reports the
+time from each order being placed to it being acknowledged FILLED.
+
+    tools/fake_cloud.py --port 5000 --clusters hadoop --boot-latency 10
+
+then point any number of agents at it:
+
+    export OS_AUTH_URL=http://127.0.0.1:5000/v2.0 OS_REGION_NAME=fake
+    export OS_USERNAME=demo OS_PASSWORD=x OS_TENANT_NAME=demo OS_TENANT_ID=demo
+
+GET /stats returns the order latencies as JSON; they are also printed on
+exit.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+
+import benchmark
+
+REGION = 'fake'
+IMAGES = [{'id': '8f5e0a62-3c1b-4f1e-9f43-5f0d2a1c7b10',
+           'name': 'Ubuntu 14.04.1 Server amd64', 'status': 'ACTIVE'}]
+FLAVORS = [{'id': '2', 'name': 'm1.small', 'ram': 2048, 'vcpus': 1,
+            'disk': 20},
+           {'id': '3', 'name': 'm1.medium', 'ram': 4096, 'vcpus': 2,
+            'disk': 40},
+           {'id': '4', 'name': 'm1.large', 'ram': 8192, 'vcpus': 4,
+            'disk': 80}]
+CLUSTER_NODE_MB = 4096
+CLUSTER_NODE_VCPUS = 2
+
+
+def isotime(when):
+    return when.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class CloudQuotas(benchmark.FakeQuotas):
+    """Quota limits over the instances the fake cloud is running."""
+
+    def __init__(self, workloads, instances, cores, ram):
+        super(CloudQuotas, self).__init__({}, 0)
+        self.workloads = workloads
+        self.quota = {'instances': instances, 'cores': cores, 'ram': ram}
+
+    def usage(self, context, project_id):
+        from nova.db.sqlalchemy import models
+        from sqlalchemy.sql import func
+
+        count, cores, ram = self.workloads.model_query(
+            context, models.Instance, (
+                func.count(models.Instance.id),
+                func.sum(models.Instance.vcpus),
+                func.sum(models.Instance.memory_mb))).\
+            filter_by(project_id=project_id).first()
+        return {'instances': count or 0, 'cores': cores or 0, 'ram': ram or 0}
+
+    def limits(self, project_id):
+        return self.quota
+
+
+class Cloud(object):
+    """The state behind every fake service."""
+
+    def __init__(self, workloads, engine, args):
+        from nova.db.sqlalchemy import models
+
+        self.workloads = workloads
+        self.instances = models.Instance.__table__
+        self.engine = engine
+        self.args = args
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.servers = {}
+        self.clusters = {}
+        self.fill_latencies = {'grow': [], 'shrink': []}
+        self.controller = workloads.WorkloadsController()
+        self.reconciler = workloads.WorkloadReconciler()
+
+    # Instances
+
+    def boot(self, project_id, name, memory_mb, vcpus, metadata=None):
+        server_id = str(uuid.uuid4())
+        now = datetime.datetime.utcnow()
+        self.engine.execute(self.instances.insert(), {
+            'uuid': server_id, 'project_id': project_id,
+            'display_name': name, 'memory_mb': memory_mb, 'vcpus': vcpus,
+            'vm_state': 'building', 'created_at': now, 'deleted': 0})
+        return {'id': server_id, 'name': name, 'tenant_id': project_id,
+                'metadata': metadata or {}, 'created': isotime(now),
+                'ready_at': time.time() + self.args.boot_latency,
+                'gone_at': None}
+
+    def destroy(self, server_id):
+        # Quota is freed at once; the server lingers in listings as
+        # "deleting" for delete_latency, as nova's would.
+        self.engine.execute(self.instances.update().where(
+            self.instances.c.uuid == server_id).values(
+            deleted=self.instances.c.id, vm_state='deleted',
+            deleted_at=datetime.datetime.utcnow()))
+
+    def server_view(self, server):
+        now = time.time()
+        status = 'ACTIVE' if now >= server['ready_at'] else 'BUILD'
+        view = dict((key, server[key]) for key in
+                    ('id', 'name', 'tenant_id', 'metadata', 'created'))
+        view['status'] = status
+        view['OS-EXT-STS:task_state'] = \
+            'deleting' if server['gone_at'] else None
+        return view
+
+    def list_servers(self, project_id, name=None):
+        now = time.time()
+        with self.lock:
+            for server_id, server in list(self.servers.items()):
+                if server['gone_at'] and server['gone_at'] <= now:
+                    del self.servers[server_id]
+            servers = [server for server in self.servers.values()
+                       if server['tenant_id'] == project_id]
+        if name:
+            servers = [server for server in servers
+                       if re.search(name, server['name'])]
+        return [self.server_view(server) for server in
+                sorted(servers, key=lambda server: server['created'])]
+
+    def create_servers(self, project_id, body):
+        server = body['server']
+        flavor = [flavor for flavor in FLAVORS
+                  if flavor['id'] == str(server['flavorRef'])]
+        if not flavor:
+            return 400, {'badRequest': {'message': 'Invalid flavorRef'}}
+        count = int(server.get('max_count') or 1)
+        names = [server['name']] if count == 1 else \
+            ['%s-%d' % (server['name'], n + 1) for n in range(count)]
+        booted = [self.boot(project_id, name, flavor[0]['ram'],
+                            flavor[0]['vcpus'], server.get('metadata'))
+                  for name in names]
+        with self.lock:
+            for server in booted:
+                self.servers[server['id']] = server
+        return 202, {'server': {'id': booted[0]['id'], 'adminPass': 'fake'}}
+
+    def delete_server(self, project_id, server_id):
+        with self.lock:
+            server = self.servers.get(server_id)
+            if (server is None or server['tenant_id'] != project_id or
+                    server['gone_at']):
+                return 404, {'itemNotFound': {'message': 'No such server'}}
+            server['gone_at'] = time.time() + self.args.delete_latency
+        self.destroy(server_id)
+        return 204, None
+
+    # Sahara clusters
+
+    def add_cluster(self, project_id, name, count):
+        cluster = {'id': str(uuid.uuid4()), 'name': name,
+                   'tenant_id': project_id, 'count': 0,
+                   'nodes': [], 'ready_at': 0, 'status': 'Active'}
+        self.resize(cluster, count)
+        self.clusters[cluster['id']] = cluster
+
+    def resize(self, cluster, count):
+        while len(cluster['nodes']) < count:
+            cluster['nodes'].append(self.boot(
+                cluster['tenant_id'], '%s-data-%03d' % (
+                    cluster['name'], len(cluster['nodes']) + 1),
+                CLUSTER_NODE_MB, CLUSTER_NODE_VCPUS)['id'])
+        while len(cluster['nodes']) > count:
+            self.destroy(cluster['nodes'].pop())
+        cluster['count'] = count
+
+    def cluster_view(self, cluster):
+        with self.lock:
+            status = cluster['status']
+            if status != 'Active' and time.time() >= cluster['ready_at']:
+                status = 'Active'
+            return {'id': cluster['id'], 'name': cluster['name'],
+                    'tenant_id': cluster['tenant_id'], 'status': status,
+                    'node_groups': [{'name': 'Data',
+                                     'count': cluster['count']}]}
+
+    def scale_cluster(self, cluster, body):
+        resize = [group for group in body.get('resize_node_groups', [])
+                  if group['name'] == 'Data']
+        if not resize:
+            return 400, {'error_message': 'Only the Data group scales'}
+        with self.lock:
+            cluster['status'] = 'Scaling'
+            cluster['ready_at'] = time.time() + self.args.scale_latency
+
+        def finish():
+            # Apply the new size before reporting Active again.
+            with self.lock:
+                self.resize(cluster, int(resize[0]['count']))
+                cluster['status'] = 'Active'
+        threading.Timer(self.args.scale_latency, finish).start()
+        return 202, {'cluster': self.cluster_view(cluster)}
+
+    # Orders
+
+    def record_fills(self, context, body):
+        """Time each order acknowledged FILLED from when it was placed."""
+        acks = body.get('order') or []
+        if isinstance(acks, dict):
+            acks = [acks]
+        ids = [int(ack['id']) for ack in acks
+               if ack.get('id') and ack.get('status') == 'FILLED']
+        if not ids:
+            return
+        Order = self.workloads.WorkloadOrder
+        rows = self.workloads.model_query(context, Order, (
+            Order.created_at, Order.instances)).\
+            filter(Order.id.in_(ids))
+        now = datetime.datetime.utcnow()
+        with self.lock:
+            for created_at, instances in rows:
+                kind = 'grow' if instances > 0 else 'shrink'
+                self.fill_latencies[kind].append(
+                    (now - created_at).total_seconds())
+
+    def stats(self):
+        with self.lock:
+            latencies = dict((kind, sorted(samples))
+                             for kind, samples in self.fill_latencies.items())
+        results = {}
+        for kind, samples in latencies.items():
+            if samples:
+                results[kind] = {
+                    'filled': len(samples),
+                    'p50_seconds': benchmark.percentile(samples, 50),
+                    'p95_seconds': benchmark.percentile(samples, 95),
+                    'p99_seconds': benchmark.percentile(samples, 99),
+                    'max_seconds': samples[-1]}
+        return {'order_to_filled': results,
+                'reconciler': dict(self.reconciler.stats),
+                'servers': len(self.servers)}
+
+    def reconcile_forever(self, stop):
+        from nova import context as nova_context
+
+        context = nova_context.get_admin_context()
+        while not stop.is_set():
+            self.reconciler.reconcile(context)
+            stop.wait(self.args.reconcile_interval)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Routes keystone, nova, os-workloads and sahara requests."""
+
+    protocol_version = 'HTTP/1.1'
+    cloud = None
+
+    def log_message(self, format, *args):
+        if self.cloud.args.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def reply(self, status, body=None, headers=None):
+        from oslo_serialization import jsonutils
+
+        data = jsonutils.dumps(body).encode('utf-8') \
+            if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, method):
+        if self.cloud.args.api_latency:
+            time.sleep(self.cloud.args.api_latency)
+        url = urlparse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8')) \
+            if length else {}
+        parts = [part for part in url.path.split('/') if part]
+
+        try:
+            if parts == ['stats']:
+                return self.reply(200, self.cloud.stats())
+            if parts == ['v2.0', 'tokens'] and method == 'POST':
+                return self.reply(200, self.authenticate(body))
+
+            project_id = self.cloud.tokens.get(
+                self.headers.get('X-Auth-Token'))
+            if project_id is None:
+                return self.reply(401, {'error': {'message': 'Unauthorized'}})
+            if parts[:2] == ['v2.1', project_id] and len(parts) > 2:
+                if parts[2] == 'os-workloads':
+                    return self.workloads(method, project_id, parts[3:],
+                                          body)
+                return self.compute(method, project_id, parts[2:], url,
+                                    body)
+            if parts[:2] == ['v1.1', project_id] and len(parts) > 2:
+                return self.sahara(method, project_id, parts[2:], body)
+            return self.reply(404, {'error': {'message': 'Not found'}})
+        except Exception as e:
+            return self.reply(500, {'error': {'message': str(e)}})
+
+    def authenticate(self, body):
+        auth = body.get('auth', {})
+        project_id = auth.get('tenantId') or auth.get('tenantName')
+        username = auth.get('passwordCredentials', {}).get('username')
+        token = uuid.uuid4().hex
+        self.cloud.tokens[token] = project_id
+        root = 'http://%s:%d' % self.server.server_address[:2]
+
+        def service(service_type, name, url):
+            return {'type': service_type, 'name': name,
+                    'endpoints': [{'region': REGION, 'publicURL': url,
+                                   'internalURL': url, 'adminURL': url}]}
+
+        now = datetime.datetime.utcnow()
+        return {'access': {
+            'token': {'id': token, 'issued_at': isotime(now),
+                      'expires': isotime(now + datetime.timedelta(days=1)),
+                      'tenant': {'id': project_id, 'name': project_id,
+                                 'enabled': True}},
+            'user': {'id': username, 'name': username, 'username': username,
+                     'roles': [{'name': 'member'}]},
+            'metadata': {'is_admin': 0, 'roles': []},
+            'serviceCatalog': [
+                service('identity', 'keystone', root + '/v2.0'),
+                service('compute', 'nova', '%s/v2.1/%s' % (root, project_id)),
+                service('computev21', 'novav21',
+                        '%s/v2.1/%s' % (root, project_id)),
+                service('data-processing', 'sahara',
+                        '%s/v1.1/%s' % (root, project_id)),
+            ]}}
+
+    def workloads(self, method, project_id, parts, body):
+        from nova.api.openstack import wsgi
+        from nova import context as nova_context
+        import webob
+        from webob import exc
+
+        cloud = self.cloud
+        context = nova_context.RequestContext('agent', project_id)
+        headers = {}
+        if self.headers.get('If-None-Match'):
+            headers['If-None-Match'] = self.headers.get('If-None-Match')
+        req = wsgi.Request.blank(self.path, headers=headers)
+        req.environ['nova.context'] = context
+
+        try:
+            if not parts:
+                if method == 'GET':
+                    result = cloud.controller.index(req)
+                else:
+                    result = cloud.controller.create(req, body)
+            elif method == 'GET':
+                result = cloud.controller.show(req, parts[0])
+            elif method == 'PUT':
+                result = cloud.controller.update(req, parts[0], body)
+                cloud.record_fills(context, body)
+            else:
+                result = cloud.controller.delete(req, parts[0])
+        except exc.HTTPException as e:
+            return self.reply(e.code, {'error': {'message': e.explanation}})
+
+        if isinstance(result, wsgi.ResponseObject):
+            return self.reply(result.code, result.obj, result.headers)
+        if isinstance(result, webob.Response):
+            # index() streams its body; gather it to send a Content-Length.
+            self.send_response(result.status_int)
+            for name, value in result.headerlist:
+                if name.lower() != 'content-length':
+                    self.send_header(name, value)
+            data = result.body
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        return self.reply(200, result)
+
+    def compute(self, method, project_id, parts, url, body):
+        cloud = self.cloud
+        query = dict(urlparse.parse_qsl(url.query))
+        if parts[0] == 'images':
+            return self.reply(200, {'images': IMAGES})
+        if parts[0] == 'flavors':
+            return self.reply(200, {'flavors': FLAVORS})
+        if parts[0] != 'servers':
+            return self.reply(404, {'itemNotFound': {'message': 'Not found'}})
+
+        if method == 'POST' and len(parts) == 1:
+            return self.reply(*cloud.create_servers(project_id, body))
+        if method == 'GET' and parts[1:] in ([], ['detail']):
+            return self.reply(200, {'servers': cloud.list_servers(
+                project_id, query.get('name'))})
+        if method == 'GET' and len(parts) == 2:
+            servers = [server for server in cloud.list_servers(project_id)
+                       if server['id'] == parts[1]]
+            if servers:
+                return self.reply(200, {'server': servers[0]})
+        if method == 'DELETE' and len(parts) == 2:
+            return self.reply(*cloud.delete_server(project_id, parts[1]))
+        return self.reply(404, {'itemNotFound': {'message': 'Not found'}})
+
+    def sahara(self, method, project_id, parts, body):
+        cloud = self.cloud
+        clusters = [cluster for cluster in cloud.clusters.values()
+                    if cluster['tenant_id'] == project_id]
+        if parts == ['clusters'] and method == 'GET':
+            return self.reply(200, {'clusters': [
+                cloud.cluster_view(cluster) for cluster in clusters]})
+        if parts[0] == 'clusters' and len(parts) == 2:
+            cluster = [cluster for cluster in clusters
+                       if cluster['id'] == parts[1]]
+            if cluster and method == 'GET':
+                return self.reply(200,
+                                  {'cluster': cloud.cluster_view(cluster[0])})
+            if cluster and method == 'PUT':
+                return self.reply(*cloud.scale_cluster(cluster[0], body))
+        return self.reply(404, {'error_message': 'Not found'})
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def seed_flavors(engine):
+    """Add FLAVORS to nova's flavor table, which sizes new orders."""
+    from nova.db.sqlalchemy import models
+
+    engine.execute(models.InstanceTypes.__table__.insert(), [
+        {'flavorid': flavor['id'], 'name': flavor['name'],
+         'memory_mb': flavor['ram'], 'vcpus': flavor['vcpus'],
+         'root_gb': flavor['disk'], 'ephemeral_gb': 0, 'swap': 0,
+         'rxtx_factor': 1.0, 'disabled': False, 'is_public': True,
+         'deleted': 0}
+        for flavor in FLAVORS])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db-url',
+                        help='database (default: a scratch SQLite file)')
+    parser.add_argument('--boot-latency', type=float, default=5.0,
+                        help='seconds servers spend in BUILD')
+    parser.add_argument('--delete-latency', type=float, default=2.0,
+                        help='seconds deleted servers stay listed')
+    parser.add_argument('--scale-latency', type=float, default=10.0,
+                        help='seconds a sahara cluster spends Scaling')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--instance-quota', type=int, default=50)
+    parser.add_argument('--cores-quota', type=int, default=50 * 2)
+    parser.add_argument('--ram-quota', type=int, default=50 * 4096)
+    parser.add_argument('--reconcile-interval', type=float, default=1.0)
+    parser.add_argument('--clusters', default='',
+                        help='comma separated sahara clusters to create, '
+                             'as project:name[:nodes] or name[:nodes] '
+                             'for the "demo" project')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+
+    connection = args.db_url
+    if not connection:
+        fd, path = tempfile.mkstemp(suffix='.sqlite', prefix='fake-cloud-')
+        os.close(fd)
+        connection = 'sqlite:///' + path
+    workloads = benchmark.setup(2.0, connection)
+    engine = benchmark.create_tables(workloads)
+    seed_flavors(engine)
+    workloads.CONF.set_override('wait_poll_interval', 0.5, group='workloads')
+    workloads.QUOTAS = CloudQuotas(workloads, args.instance_quota,
+                                   args.cores_quota, args.ram_quota)
+
+    cloud = Cloud(workloads, engine, args)
+    for spec in filter(None, args.clusters.split(',')):
+        fields = spec.split(':')
+        if not fields[-1].isdigit():
+            fields.append('3')
+        if len(fields) == 2:
+            fields.insert(0, 'demo')
+        cloud.add_cluster(fields[0], fields[1], int(fields[2]))
+
+    Handler.cloud = cloud
+    server = Server((args.host, args.port), Handler)
+    stop = threading.Event()
+    reconciler = threading.Thread(target=cloud.reconcile_forever,
+                                  args=(stop,))
+    reconciler.daemon = True
+    reconciler.start()
+
+    def shutdown(signum, frame):
+        stop.set()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print('Serving on http://%s:%d/v2.0 (database %s)' % (
+        args.host, args.port, connection))
+    server.serve_forever()
+    print(json.dumps(cloud.stats(), indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,10 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import datetime
+import functools
 import itertools
+import math
 import os
+import sys
+import threading
+import time
 
 from oslo_config import cfg
+import webob
 from webob import exc
 
 from nova.api.openstack import common
@@ -25,6 +33,9 @@ from nova.api.openstack import wsgi
 from nova.api import validation
 from nova import exception
 from nova import compute
+from nova.compute import flavors
+from nova import config
+from nova import context as nova_context
 from nova import objects
 from nova.i18n import _
 from nova import utils
@@ -33,12 +44,16 @@ from nova import quota
 from oslo_config import cfg
 
 from sqlalchemy import (Column, Index, Integer, BigInteger, Enum, String,
-                        schema, Unicode, or_)
+                        schema, Unicode, or_, case)
 from sqlalchemy.dialects.mysql import MEDIUMTEXT
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import orm, and_
+from sqlalchemy.orm import exc as orm_exc
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text, Float
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from nova.db.sqlalchemy.models import NovaBase
+from nova.db.sqlalchemy.api import get_session
 from nova.db.sqlalchemy.api import model_query
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import asc
@@ -47,7 +62,11 @@ from sqlalchemy.sql.expression import desc
 from nova.db.sqlalchemy import types
 from nova.db.sqlalchemy.models import Instance
 from nova.compute import vm_states
+from oslo_db import exception as db_exc
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_service import loopingcall
+from oslo_utils import timeutils
 
 LOG = logging.getLogger(__name__)
 ALIAS = "os-workloads"
@@ -56,52 +75,709 @@ CONF = cfg.CONF
 BASE = declarative_base()
 QUOTAS = quota.QUOTAS
 ORDER_STATUSES = ["OPEN","FILLED","PENDING","ERROR","WORKING"]
+# The keys index() can return for each workload, in its default order.
+INDEX_FIELDS = ("id", "name", "priority", "instances", "memory_mb", "vcpus")
+# An order in one of these has been dealt with and can't change again.
+FINAL_STATUSES = ("FILLED", "ERROR")
+# The WorkloadOrder column recording when an order last entered each status.
+STATUS_TIMESTAMPS = {"PENDING": "pending_at",
+                     "OPEN": "opened_at",
+                     "WORKING": "working_at",
+                     "FILLED": "filled_at",
+                     "ERROR": "error_at"}
+
+workloads_opts = [
+    cfg.IntOpt('reconcile_interval',
+               default=10,
+               help='Seconds between reconciler passes, which open pending '
+                    'orders that now fit under quota and ask lower priority '
+                    'workloads to scale down.'),
+    cfg.BoolOpt('reconcile_in_api',
+                default=False,
+                help='Run the reconciler inside the API service. Leave off '
+                     'when running the standalone reconciler worker or more '
+                     'than one API worker.'),
+    cfg.IntOpt('max_wait',
+               default=60,
+               help='Longest, in seconds, a GET /os-workloads/{id}?wait=N '
+                    'long-poll is held open.'),
+    cfg.FloatOpt('wait_poll_interval',
+                 default=1.0,
+                 help='Seconds between order checks while a long-poll is '
+                      'held, for orders opened by other processes.'),
+    cfg.FloatOpt('quota_cache_ttl',
+                 default=2.0,
+                 help='Seconds a project\'s quota usage snapshot is reused '
+                      'for order admission before it is read again. 0 '
+                      'disables the cache.'),
+    cfg.IntOpt('reservation_expire',
+               default=1800,
+               help='Seconds the quota reserved for an OPEN grow order is '
+                    'held if its agent never starts on it.'),
+    cfg.IntOpt('working_timeout',
+               default=7200,
+               help='Seconds an order may stay WORKING before the '
+                    'reconciler gives up on its agent and marks it ERROR.'),
+    cfg.IntOpt('scale_down_timeout',
+               default=3600,
+               help='Seconds a scale-down may stay OPEN before the '
+                    'reconciler marks it ERROR and stops crediting it to '
+                    'the order it serves.'),
+    cfg.IntOpt('order_update_attempts',
+               default=3,
+               help='Times update() retries its transaction when another '
+                    'worker changes one of its orders first.'),
+    cfg.IntOpt('latency_window',
+               default=86400,
+               help='Seconds of order history GET /os-workloads/latency '
+                    'summarises when the request gives no ?window=.'),
+    cfg.IntOpt('max_latency_window',
+               default=90 * 86400,
+               help='Largest ?window=, in seconds, GET '
+                    '/os-workloads/latency accepts.'),
+    cfg.IntOpt('index_etag_max_age',
+               default=10,
+               help='Seconds a workload listing\'s ETag stays valid while no '
+                    'workload or order in the project changes. This bounds '
+                    'how stale the instance counts behind a 304 can be.'),
+    cfg.StrOpt('default_flavor',
+               default='m1.medium',
+               help='Name or id of the flavor a new order is sized from '
+                    'when it names no flavor and leaves out memory_mb or '
+                    'vcpus.'),
+]
+CONF.register_opts(workloads_opts, group='workloads')
+
+
+class QueryCounter(object):
+    """Counts the SQL statements issued by the current (green)thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        event.listen(Engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+QUERY_COUNTER = QueryCounter()
+
+
+class Metrics(object):
+    """
+    Per-process timings and counters for the workloads extension.
+
+    Each timed handler records its calls, wall time, SQL statements and
+    quota reads; order status changes are counted by transition.  Served
+    to admins by GET /os-workloads/metrics.  The standalone reconciler
+    runs in its own process and logs its metrics at debug level instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.handlers = {}
+        self.transitions = collections.Counter()
+        self.counters = collections.Counter()
+
+    @property
+    def quota_reads(self):
+        return getattr(self._local, 'quota_reads', 0)
+
+    def quota_read(self):
+        """Count a QUOTAS read made by the current (green)thread."""
+        self._local.quota_reads = self.quota_reads + 1
+
+    def timed(self, name):
+        """Decorate a handler to record its time, queries and quota reads."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                queries = QUERY_COUNTER.count
+                quota_reads = self.quota_reads
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.record(name, time.time() - start,
+                                QUERY_COUNTER.count - queries,
+                                self.quota_reads - quota_reads)
+            return wrapper
+        return decorator
+
+    def record(self, name, seconds, queries, quota_reads):
+        with self._lock:
+            handler = self.handlers.get(name)
+            if handler is None:
+                handler = self.handlers[name] = {"calls": 0,
+                                                 "seconds": 0.0,
+                                                 "max_seconds": 0.0,
+                                                 "queries": 0,
+                                                 "quota_reads": 0}
+            handler["calls"] += 1
+            handler["seconds"] += seconds
+            handler["max_seconds"] = max(handler["max_seconds"], seconds)
+            handler["queries"] += queries
+            handler["quota_reads"] += quota_reads
+
+    def transition(self, old, new, count=1):
+        """Count orders moving from status old (None: created) to new."""
+        if count:
+            with self._lock:
+                self.transitions[(old or "NEW", new)] += count
+
+    def count(self, name, count=1):
+        if count:
+            with self._lock:
+                self.counters[name] += count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "handlers": dict((name, dict(handler)) for name, handler
+                                 in self.handlers.items()),
+                "transitions": dict(("%s->%s" % key, count) for key, count
+                                    in self.transitions.items()),
+                "counters": dict(self.counters),
+                "quota_cache": QUOTA_CACHE.stats(),
+            }
+
+    def prometheus(self):
+        """The snapshot in the Prometheus text exposition format."""
+        with self._lock:
+            handlers = sorted((name, dict(handler)) for name, handler
+                              in self.handlers.items())
+            transitions = sorted(self.transitions.items())
+            counters = sorted(self.counters.items())
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s{%s} %s" % (name, ",".join(
+                    '%s="%s"' % label for label in labels), value))
+
+        for field, kind, description in (
+                ("calls", "counter", "Handler calls."),
+                ("seconds", "counter", "Seconds spent in the handler."),
+                ("max_seconds", "gauge", "Slowest handler call."),
+                ("queries", "counter", "SQL statements issued."),
+                ("quota_reads", "counter", "Quota usage reads.")):
+            family("workloads_handler_%s%s" % (
+                       field, "_total" if kind == "counter" else ""),
+                   kind, description,
+                   [((("handler", name),), handler[field])
+                    for name, handler in handlers])
+        family("workloads_order_transitions_total", "counter",
+               "Orders moved between statuses.",
+               [((("from", old), ("to", new)), count)
+                for (old, new), count in transitions])
+        family("workloads_events_total", "counter",
+               "Other workload events.",
+               [((("event", name),), count) for name, count in counters])
+        cache = QUOTA_CACHE.stats()
+        family("workloads_quota_cache_total", "counter",
+               "Quota cache lookups.",
+               [((("result", "hit"),), cache["hits"]),
+                ((("result", "miss"),), cache["misses"])])
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+
+def workload_names_for(display_name):
+    """
+    Yield every workload name an instance display name could belong to.
+
+    Mirrors the "name-%" and "name -%" patterns agents boot servers with,
+    so an instance is attributed to each workload whose name is a prefix
+    of its display name followed by a dash.
+    """
+    i = display_name.find("-")
+    while i != -1:
+        yield display_name[:i]
+        if i and display_name[i - 1] == " ":
+            yield display_name[:i - 1]
+        i = display_name.find("-", i + 1)
+
+
+def bump_versions(context, project_id, workload_ids=(), session=None):
+    """
+    Move on the ETag versions of a project and some of its workloads.
+
+    Called whenever a workload or one of its orders changes, so index()
+    and show() can answer If-None-Match without reading orders.
+    """
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        if workload_ids:
+            model_query(context, Workload, session=session,
+                        read_deleted="yes").\
+                filter(Workload.id.in_(set(workload_ids))).\
+                update({"version": Workload.version + 1},
+                       synchronize_session=False)
+
+        query = model_query(context, WorkloadProject, session=session).\
+            filter_by(project_id=project_id)
+        if query.update({"version": WorkloadProject.version + 1},
+                        synchronize_session=False):
+            return
+        # First change since the project's row existed.
+        try:
+            with session.begin_nested():
+                project = WorkloadProject()
+                project.project_id = project_id
+                project.version = 1
+                session.add(project)
+        except db_exc.DBDuplicateEntry:
+            query.update({"version": WorkloadProject.version + 1},
+                         synchronize_session=False)
+
+
+def workload_projects(context, workload_ids):
+    """
+    Return {workload id: project id} for workload_ids, deleted or not.
+
+    Lets the reconciler's sweeps across every project read orders by
+    status alone and look up their projects by id, rather than join,
+    which has the database walk every workload.
+    """
+    if not workload_ids:
+        return {}
+    return dict(model_query(context, Workload, (
+        Workload.id,
+        Workload.project_id), read_deleted="yes").\
+        filter(Workload.id.in_(set(workload_ids))))
+
+
+def project_version(context, project_id):
+    return model_query(context, WorkloadProject, (WorkloadProject.version,)).\
+        filter_by(project_id=project_id).scalar() or 0
+
+
+def quota_context(context, project_id, user_id):
+    """
+    A copy of context acting as project_id and user_id.
+
+    Nova's quota engine falls back to the context's user when passed none,
+    so reserving and rolling back under the same stored user, even an
+    unknown one, needs a context that agrees with it.
+    """
+    quota_ctx = context.elevated()
+    quota_ctx.project_id = project_id
+    quota_ctx.user_id = user_id
+    return quota_ctx
+
+
+def reserve_order(context, project_id, user_id, demand):
+    """
+    Reserve demand, the quota a grow order about to be opened will boot
+    into, for the user who placed it.
+
+    Returns the reservation ids, or None if the project no longer has
+    room, for instance because another API worker opened an order first.
+    """
+    try:
+        return QUOTAS.reserve(quota_context(context, project_id, user_id),
+                              expire=CONF.workloads.reservation_expire,
+                              project_id=project_id, user_id=user_id,
+                              **demand)
+    except exception.OverQuota:
+        return None
+
+
+def release_reservations(context, project_id, user_id, reservations):
+    """Roll back reservations reserve_order() took for user_id."""
+    if not reservations:
+        return
+    try:
+        QUOTAS.rollback(quota_context(context, project_id, user_id),
+                        reservations, project_id=project_id,
+                        user_id=user_id)
+    except Exception:
+        LOG.exception("Failed to release workload order reservations %s",
+                      reservations)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def latency_summary(seconds):
+    """Count, p50 and p95 of a list of durations."""
+    seconds = sorted(seconds)
+    if not seconds:
+        return {"count": 0, "p50": None, "p95": None}
+    return {"count": len(seconds),
+            "p50": percentile(seconds, 50),
+            "p95": percentile(seconds, 95)}
+
+
+def find_flavor(context, name):
+    """The flavor called name, or failing that with flavor id name."""
+    try:
+        return flavors.get_flavor_by_name(name, context)
+    except exception.NotFound:
+        pass
+    try:
+        return flavors.get_flavor_by_flavor_id(name, context,
+                                               read_deleted="no")
+    except exception.NotFound:
+        return None
+
+
+def order_size(context, order_req):
+    """
+    Size each instance a new order asks for.
+
+    Returns {"flavor_id", "memory_mb", "vcpus", "disk_gb"}, or None if the
+    order names a flavor that doesn't exist.  memory_mb, vcpus and
+    disk_gb given in the order win over its flavor's; an order naming no
+    flavor that leaves out memory_mb or vcpus is sized from
+    default_flavor.
+    """
+    name = order_req.get("flavor")
+    flavor = None
+    if name or not (order_req.get("memory_mb") and order_req.get("vcpus")):
+        flavor = find_flavor(context, name or CONF.workloads.default_flavor)
+        if flavor is None and name:
+            return None
+    size = {"flavor_id": None, "memory_mb": 0, "vcpus": 0, "disk_gb": 0}
+    if flavor is not None:
+        size = {"flavor_id": flavor.flavorid,
+                "memory_mb": flavor.memory_mb,
+                "vcpus": flavor.vcpus,
+                "disk_gb": (flavor.root_gb or 0) + (flavor.ephemeral_gb or 0)}
+    for key in ("memory_mb", "vcpus", "disk_gb"):
+        if order_req.get(key):
+            size[key] = order_req[key]
+    return size
+
+
+class OrderSizer(object):
+    """
+    Works out the quota stored orders demand.
+
+    Orders placed before they were sized (migration 285) have no vcpus
+    and often no memory_mb; they are taken to be default_flavor, which is
+    looked up at most once.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.default = None
+
+    def demand(self, instances, memory_mb, vcpus):
+        if not (memory_mb and vcpus):
+            if self.default is None:
+                self.default = order_size(self.context, {})
+            memory_mb = memory_mb or self.default["memory_mb"]
+            vcpus = vcpus or self.default["vcpus"]
+        return Headroom.demand(instances, memory_mb, vcpus)
+
+
+def instance_usage(context, project_id, names):
+    """
+    Return {workload name: [instances, memory_mb, vcpus]} for the project.
+
+    Reads the project's live instances once and attributes them to
+    workloads in Python, rather than running a LIKE scan over the
+    instances table for every workload.
+    """
+    usage = collections.defaultdict(lambda: [0, 0, 0])
+    rows = model_query(context, Instance, (
+        Instance.display_name,
+        Instance.memory_mb,
+        Instance.vcpus)).\
+        filter(and_(
+            Instance.deleted != Instance.id,
+            Instance.vm_state != vm_states.SOFT_DELETED
+            )).\
+        filter_by(project_id=project_id)
+
+    for display_name, memory_mb, vcpus in rows:
+        for name in workload_names_for(display_name or ""):
+            if name in names:
+                usage[name][0] += 1
+                usage[name][1] += memory_mb or 0
+                usage[name][2] += vcpus or 0
+    return usage
+
+
+def not_modified(etag):
+    """A bodiless 304 response carrying etag."""
+    resp = wsgi.ResponseObject(None, code=304)
+    resp['ETag'] = '"%s"' % etag
+    return resp
+
+
+class OrderWaiters(object):
+    """
+    Wakes long-polling show() requests when this process opens orders.
+
+    Orders opened by other API workers or the standalone reconciler are
+    only seen on the next wait_poll_interval check.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def wait(self, workload_id, timeout):
+        with self._lock:
+            event = self._events.setdefault(workload_id, threading.Event())
+        event.wait(timeout)
+
+    def notify(self, workload_ids):
+        with self._lock:
+            events = [self._events.pop(workload_id, None)
+                      for workload_id in set(workload_ids)]
+        for event in events:
+            if event:
+                event.set()
+
+ORDER_WAITERS = OrderWaiters()
+
+
+class QuotaCache(object):
+    """
+    Short-lived per-project snapshots of QUOTAS.get_project_quotas().
+
+    Admission checks in update() and the reconciler share a snapshot for
+    up to quota_cache_ttl seconds; creating, opening or filling orders
+    drops the project's snapshot so the next check reads fresh usage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, context, project_id):
+        ttl = CONF.workloads.quota_cache_ttl
+        now = time.time()
+        with self._lock:
+            snapshot = self._snapshots.get(project_id)
+        if snapshot and now - snapshot[0] < ttl:
+            self.hits += 1
+            return snapshot[1]
+
+        self.misses += 1
+        METRICS.quota_read()
+        quotas = QUOTAS.get_project_quotas(context, project_id)
+        if ttl > 0:
+            with self._lock:
+                self._snapshots[project_id] = (now, quotas)
+        return quotas
+
+    def invalidate(self, project_id):
+        with self._lock:
+            self._snapshots.pop(project_id, None)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._snapshots)
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+QUOTA_CACHE = QuotaCache()
+
+
+class Headroom(object):
+    """Quota a project has left, used up as orders are admitted against it."""
+
+    # The quota nova checks when booting a server.  There is no disk
+    # quota, so an order's disk_gb is recorded but not admitted against.
+    RESOURCES = ("instances", "cores", "ram")
+
+    def __init__(self, quotas):
+        # Resources with a negative limit are unlimited and never tracked.
+        self.free = {}
+        for resource in self.RESOURCES:
+            entry = quotas.get(resource)
+            if entry and entry['limit'] >= 0:
+                self.free[resource] = (entry['limit'] - entry['in_use'] -
+                                       entry['reserved'])
+
+    @staticmethod
+    def demand(instances, memory_mb, vcpus):
+        """The quota a grow order for instances servers will consume."""
+        instances = instances or 1
+        return {"instances": instances,
+                "cores": (vcpus or 0) * instances,
+                "ram": (memory_mb or 0) * instances}
+
+    def fits(self, demand):
+        return all(self.free[resource] >= demand[resource]
+                   for resource in self.free)
+
+    def shortfall(self, demand):
+        """How much more of each resource demand needs than is free."""
+        return dict((resource, max(0, demand[resource] - free))
+                    for resource, free in self.free.items())
+
+    def release(self, amount):
+        """Give back capacity, such as a scale-down will free."""
+        for resource in self.free:
+            self.free[resource] += amount[resource]
+
+    def admit(self, demand):
+        """Claim demand from the headroom if it fits; return whether it did."""
+        if not self.fits(demand):
+            return False
+        for resource in self.free:
+            self.free[resource] -= demand[resource]
+        return True
+
+    def admit_batch(self, demands):
+        """
+        Claim each of demands, in order, that fits; return their indexes.
+
+        The batch's total is checked against every resource first, and
+        when it all fits, as it usually does, it is claimed in one go.
+        Otherwise demands that would overrun any resource are passed over
+        and later, smaller ones may still be admitted.
+        """
+        total = collections.Counter()
+        for demand in demands:
+            total.update(demand)
+        if self.admit(total):
+            return list(range(len(demands)))
+        return [i for i, demand in enumerate(demands) if self.admit(demand)]
+
 
 class WorkloadsController(wsgi.Controller):
 
     def __init__(self, network_api=None):
         self.compute_api = compute.API(skip_policy_check=True)
         self.last_call = {}
+        if CONF.workloads.reconcile_in_api:
+            start_reconciler()
 
     def workloads_get_all(self,context):
         return model_query(context, Workload).\
                    filter_by(project_id=context.project_id)
 
-    @extensions.expected_errors(503)
+    def index_params(self, req):
+        """
+        Parse index()'s query parameters, raising HTTPBadRequest.
+
+        Returns (limit, marker, name_prefix, priority_min, priority_max,
+        fields).
+        """
+        def integer(name, value):
+            if value is None:
+                return None
+            try:
+                return int(value)
+            except ValueError:
+                raise exc.HTTPBadRequest(
+                    explanation=_("%s must be an integer") % name)
+
+        limit, marker = common.get_limit_and_marker(req)
+        fields = INDEX_FIELDS
+        if req.GET.get("fields"):
+            fields = tuple(field.strip()
+                           for field in req.GET["fields"].split(","))
+            unknown = set(fields) - set(INDEX_FIELDS)
+            if unknown:
+                raise exc.HTTPBadRequest(
+                    explanation=_("Unknown fields: %s") %
+                    ", ".join(sorted(unknown)))
+        return (limit, integer("marker", marker), req.GET.get("name_prefix"),
+                integer("priority_min", req.GET.get("priority_min")),
+                integer("priority_max", req.GET.get("priority_max")), fields)
+
+    @extensions.expected_errors((400, 503))
+    @METRICS.timed("index")
     def index(self, req):
-        """Return a list of all workloads."""
+        """
+        List the project's workloads, in id order.
+
+        ?limit=N&marker=<last id> pages through them, limit defaulting to
+        and capped at osapi_max_limit, with a "next" link while more
+        remain.  name_prefix=, priority_min= and priority_max= filter
+        them.  fields=id,name,... picks the keys returned; leaving out
+        instances, memory_mb and vcpus skips counting the project's
+        instances.
+        The page of workloads and their instance counts are read before
+        the response starts; only the JSON is encoded a workload at a time
+        as the body is sent, so a full page is never held as one string.
+        """
         context = req.environ['nova.context']
         authorize(context)
-        workloads = []
-
-        builds = self.workloads_get_all(context)
-
-        for workload in builds:
-            LOG.debug("Inspecting workload %s", workload.name)
-
-            result = model_query(context, Instance, (
-                func.count(Instance.id),
-                func.sum(Instance.memory_mb))).\
-                filter(or_(Instance.display_name.like(workload.name+"-%"),
-                    Instance.display_name.like(workload.name+"\ -%"))).\
-                filter(and_(
-                    Instance.deleted != Instance.id,
-                    Instance.vm_state != vm_states.SOFT_DELETED
-                    )).\
-                filter_by(project_id=context.project_id).first()
-
-            instances = result[0]
-            memory_mb = result[1] or 0
-            workloads.append({
-                           'id': workload.id,
-                           'name': workload.name,
-                           'priority': workload.priority,
-                           'instances': instances,
-                           'memory_mb': int(memory_mb)})
-        #LOG.debug("Got result %s", str(workloads))
-
-        return {'workloads': workloads}
-
+        start = QUERY_COUNTER.count
+        (limit, marker, name_prefix, priority_min, priority_max,
+         fields) = self.index_params(req)
+
+        # Instance counts can change without a workload or order changing,
+        # so the ETag also rolls over every index_etag_max_age seconds.
+        etag = "p%d-%d" % (project_version(context, context.project_id),
+                           int(time.time() /
+                               max(1, CONF.workloads.index_etag_max_age)))
+        if etag in req.if_none_match:
+            resp = not_modified(etag)
+            resp['X-Workloads-Query-Count'] = str(QUERY_COUNTER.count - start)
+            return resp
+
+        query = self.workloads_get_all(context)
+        if marker is not None:
+            query = query.filter(Workload.id > marker)
+        if name_prefix:
+            escaped = name_prefix.replace("\\", "\\\\").\
+                replace("%", "\\%").replace("_", "\\_")
+            query = query.filter(Workload.name.like(escaped + "%",
+                                                    escape="\\"))
+        if priority_min is not None:
+            query = query.filter(Workload.priority >= priority_min)
+        if priority_max is not None:
+            query = query.filter(Workload.priority <= priority_max)
+        builds = query.order_by(asc(Workload.id)).limit(limit).all()
+
+        usage = {}
+        if set(fields) & set(("instances", "memory_mb", "vcpus")):
+            usage = instance_usage(context, context.project_id,
+                                   set(workload.name for workload in builds))
+        links = common.ViewBuilder()._get_collection_links(
+            req, [{"id": workload.id} for workload in builds], ALIAS, "id")
+
+        queries = QUERY_COUNTER.count - start
+        LOG.debug("Listed %d workloads in %d queries", len(builds), queries)
+
+        def body():
+            yield b'{"workloads": ['
+            for i, workload in enumerate(builds):
+                instances, memory_mb, vcpus = usage.get(workload.name,
+                                                        (0, 0, 0))
+                values = {'id': workload.id,
+                          'name': workload.name,
+                          'priority': workload.priority,
+                          'instances': instances,
+                          'memory_mb': int(memory_mb),
+                          'vcpus': int(vcpus)}
+                item = jsonutils.dumps(dict((field, values[field])
+                                            for field in fields))
+                yield ((", " if i else "") + item).encode("utf-8")
+            yield b"]"
+            if links:
+                yield (', "workloads_links": %s' %
+                       jsonutils.dumps(links)).encode("utf-8")
+            yield b"}"
+
+        resp = webob.Response(app_iter=body(),
+                              content_type="application/json",
+                              charset="utf-8")
+        resp.headers['X-Workloads-Query-Count'] = str(queries)
+        resp.headers['ETag'] = '"%s"' % etag
+        return resp
+
+    @METRICS.timed("create")
     def create(self, req, body):
         """
         Create workload.
@@ -114,123 +790,72 @@ class WorkloadsController(wsgi.Controller):
         workload.project_id = context.project_id
         workload.priority = int(params.get('priority') or 1)
         workload.save()
+        bump_versions(context, context.project_id)
         return {'workload': workload}
 
-    def update_pending_orders(self, context):
-
-        orders = model_query(context, WorkloadOrder).\
-                filter_by(status="PENDING").\
-                join((Workload,
-                Workload.id == WorkloadOrder.workload_id)).\
-                filter_by(project_id = context.project_id).\
-                order_by(asc(Workload.priority))
-        orderlist = []
-        for order in orders:
-            orderlist.append(order['id'])
-
-        # We seem to have to do this two-step because of SQLAlchemy
-        # Session issues
-        
-        for order_id in orderlist:
-
-            order = model_query(context, WorkloadOrder).\
-                   filter_by(id=order_id).first()
-            quotas = QUOTAS.get_project_quotas(context, context.project_id)
-            ram_clear = instances_clear = False
-            for entry in quotas:
-                if entry == "ram":
-                    ram_clear = (quotas[entry]['reserved']+quotas[entry]['in_use']+((order["memory_mb"] or 1024)*order['instances'])) <= quotas[entry]['limit']
-                if entry == "instances":
-                    instances_clear = (quotas[entry]['reserved']+quotas[entry]['in_use']+(order["instances"] or 1)) <= quotas[entry]['limit']
-            if instances_clear and ram_clear:
-                LOG.debug("Updating order status to open %s", (str(order['id'])))
-                order.status = "OPEN"
-                order.save()
-
+    def open_orders(self, context, workload_id):
+        query = model_query(context, WorkloadOrder).\
+               filter_by(workload_id=workload_id).\
+               filter_by(status="OPEN")
+        return [{"id":order.id,"instances":order.instances,"memory_mb":order.memory_mb,
+                 "vcpus":order.vcpus,"disk_gb":order.disk_gb,"flavor_id":order.flavor_id}
+                for order in query]
 
+    @extensions.expected_errors(400)
+    @METRICS.timed("show")
     def show(self, req, id):
+        """
+        List a workload's open orders.
+
+        With ?wait=N&since=<version> the request is held for up to N
+        seconds (capped at max_wait) until the workload's version moves on
+        from the one the caller last saw, so agents don't have to poll.
+        An If-None-Match matching the current ETag gets a 304 without the
+        orders being read.
+        """
         context = req.environ['nova.context']
         authorize(context)
 
-        # Check to see if we have workload orders that should be open
-        self.update_pending_orders(context)
+        try:
+            wait = max(0, min(int(req.GET.get("wait", 0)),
+                              CONF.workloads.max_wait))
+        except ValueError:
+            raise exc.HTTPBadRequest(explanation=_("wait must be an integer"))
+        since = req.GET.get("since")
 
         query = model_query(context, Workload).\
                    filter_by(project_id=context.project_id).\
                    filter_by(id=int(id))
         workload = query.first()
-        orders = []
 
         if workload:
-            # Check and see if we're elidgible for scale-down.
-            # We aren't if we already have open scale-down
-            # orders.
-
-            elidgible = True
-            query = model_query(context, WorkloadOrder).\
-                        filter(or_(
-                        WorkloadOrder.status == "OPEN",
-                        WorkloadOrder.status == "WORKING"
-                        )).filter_by(workload_id=workload.id)
-
-            for order in query:
-                if order['instances'] < 0:
-                    # Pre-existing scale down order.
-                    elidgible = False
-
-            if elidgible:
-                # First check to see if there are pending orders for
-                # higher priority workloads.
-
-                query = model_query(context, WorkloadOrder).\
-                        filter_by(status="PENDING").\
-                        join((Workload,
-                        Workload.id == WorkloadOrder.workload_id)).\
-                        filter_by(project_id = context.project_id).\
-                        filter(Workload.priority < workload.priority)
-
-                for pending in query:
-                    # We have a higher priority workload in a pending state, insert a scale-down order.
-                    # This should probably check and ensure an existing scale-down order doesn't exist.
-                    order = WorkloadOrder()
-                    order.workload_id = workload.id
-                    order.instances = pending['instances'] * -1
-                    order.memory_mb = pending['memory_mb']
-                    order.status = "OPEN"
-                    order.save()
-                    # Only handle one at a time.
+            # Pending orders are opened, and scale-downs requested, by the
+            # reconciler; all we do here is list the orders we have open.
+
+            version = workload.version
+            deadline = time.time() + wait
+            while since is not None and str(version) == since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
                     break
-
-            # # Check and see if we have pending orders that
-            # # can now be opened.
-            
-            # query = model_query(context, WorkloadOrder).\
-            #        filter_by(workload_id=workload.id).\
-            #        filter_by(status="PENDING")
-
-            # for order in query:
-            #     quotas = QUOTAS.get_project_quotas(context, context.project_id)
-            #     ram_clear = instances_clear = False
-            #     for entry in quotas:
-            #         if entry == "ram":
-            #             ram_clear = (quotas[entry]['reserved']+quotas[entry]['in_use']+(order["memory_mb"] or 1024)) <= quotas[entry]['limit']
-            #         if entry == "instances":
-            #             instances_clear = (quotas[entry]['reserved']+quotas[entry]['in_use']+(order["instances"] or 1)) <= quotas[entry]['limit']
-            #     if ram_clear and instances_clear:
-            #         order.status = "OPEN"
-            #         order.save()
-
-            # Now list the orders we have open.
-
-            query = model_query(context, WorkloadOrder).\
-                   filter_by(workload_id=workload.id).\
-                   filter_by(status="OPEN")
-            for order in query:
-                orders.append({"id":order.id,"instances":order.instances,"memory_mb":order.memory_mb})
+                ORDER_WAITERS.wait(workload.id, min(
+                    remaining, CONF.workloads.wait_poll_interval))
+                version = model_query(context, Workload,
+                                      (Workload.version,)).\
+                    filter_by(id=workload.id).scalar()
+
+            etag = "w%d-%s" % (workload.id, version)
+            if etag in req.if_none_match:
+                return not_modified(etag)
+            orders = self.open_orders(context, workload.id)
         else:
             return {}
-        return {"orders":orders}
+        resp = wsgi.ResponseObject({"orders":orders,"version":str(version)})
+        resp['ETag'] = '"%s"' % etag
+        return resp
 
+    @extensions.expected_errors(409)
+    @METRICS.timed("update")
     def update(self,req, id, body):
         """
         Update a workload. 
@@ -239,88 +864,219 @@ class WorkloadsController(wsgi.Controller):
 
         {"workload": {"name": "New Name", "priority": 5}}
 
-        {"order": {"id": 1, "status": "FILLED"}}
+        {"order": [{"id": 1, "status": "FILLED"}, {"id": 2, "status": "FILLED"}]}
 
-        {"order": {"instances": 1, "memory_mb": 4096}}
+        {"order": [{"instances": 1, "memory_mb": 4096}]}
 
+        Every order in a request is applied in one transaction against a
+        single quota read.  "results" holds one entry per requested order,
+        in request order: the order's id and status, or an error.  If
+        another worker changes one of the orders meanwhile the transaction
+        is retried, up to order_update_attempts times, then 409 returned.
         """
         context = req.environ['nova.context']
         authorize(context)
-        workload = model_query(context, Workload).\
-                   filter_by(project_id=context.project_id).\
-                   filter_by(id=int(id)).first()
+        attempts = max(1, CONF.workloads.order_update_attempts)
+        for attempt in range(1, attempts + 1):
+            changes = collections.defaultdict(list)
+            try:
+                workload, orders, results = self._update(context, id, body,
+                                                         changes)
+                break
+            except orm_exc.StaleDataError:
+                # Another worker changed one of the orders since we read
+                # it; start again from what it wrote.
+                release_reservations(context, context.project_id,
+                                     context.user_id, changes["reserved"])
+                METRICS.count("order_update_conflicts")
+                LOG.debug("Workload %s orders changed concurrently, "
+                          "attempt %d of %d", id, attempt, attempts)
+                if attempt == attempts:
+                    raise exc.HTTPConflict(explanation=_(
+                        "The workload's orders changed concurrently; "
+                        "retry the request."))
+            except Exception:
+                release_reservations(context, context.project_id,
+                                     context.user_id, changes["reserved"])
+                raise
+
+        for old, new in changes["transitions"]:
+            METRICS.transition(old, new)
+        for user_id, reservations in changes["released"]:
+            release_reservations(context, context.project_id, user_id,
+                                 reservations)
+        if orders:
+            QUOTA_CACHE.invalidate(context.project_id)
+        if any(order.status == "OPEN" for order in orders):
+            ORDER_WAITERS.notify([workload.id])
+        return {"workload":workload,"order":orders,"results":results}
+
+    def _update(self, context, id, body, changes):
+        """
+        One attempt at update()'s transaction.
+
+        Returns (workload, orders, results).  Every order change is a
+        compare-and-swap on the order's version, so this raises
+        StaleDataError, rolling everything back, if another worker changed
+        one of the orders after we read it.
+        """
+        session = get_session()
+        workload = None
         orders = []
-        if workload:
-            if body.get("workload"):
-                if body['workload'].get("name"):
-                    workload.name = body['workload'].get("name")
-                if body['workload'].get("priority"):
-                    workload.priority = body['workload'].get("priority")
-                workload.save()
-            if body.get("order"):
-                for order_req in body.get("order"):
-
-                    if order_req.get("id"):
-                        # We're updating an existing order.
-                        order = model_query(context, WorkloadOrder).\
-                            filter_by(workload_id=workload.id).\
-                            filter_by(id=order_req['id']).first()
-
-                        if order.status == "OPEN" or order.status == "PENDING":
-                            if order_req.get("instances"):
-                                order.instances = order_req.get("instances")
-                            if order_req.get("memory_mb"):
-                                order.memory_mb = order_req.get("memory_mb")
-
-                        if order_req.get("status") and order_req.get("status") in ORDER_STATUSES:
-                            order.status = order_req.get("status")
-                        order.save()
-                        orders.append(order)
-
-                    elif order_req.get("instances") or order_req.get("memory_mb"):
-                        
-                        # We're creating a new order.
-
-                        # At some point we should check if we have
-                        # an existing open/pending order and just update that.
-
-                        order_status = "OPEN"
-
-                        # If it's a grow order, check and see if we're at capacity.
-
-                        if (order_req.get("instances") or 1) > 0:
-                            # Check to see if we have a pending order.
-                            pending_order = model_query(context, WorkloadOrder).\
-                                filter_by(workload_id=workload.id).\
-                                filter(or_(WorkloadOrder.status=="PENDING",WorkloadOrder.status=="OPEN")).\
-                                filter(WorkloadOrder.instances >= 1).first()
-                            if pending_order:
-                                return {"status":"Failure","message":"Existing pending or open order."}
-                                
-                            # We're growing, check to see if we can fit under quota limits.
-
-                            quotas = QUOTAS.get_project_quotas(context, context.project_id)
-                            instances = order_req.get("instances") or 1
-
-                            for entry in quotas:
-                                if entry == "ram":
-                                    LOG.debug("Quota check %s", str(quotas[entry]['reserved']+quotas[entry]['in_use']+(order_req.get("memory_mb") or 1024)))
-                                    if (quotas[entry]['reserved']+quotas[entry]['in_use']+((order_req.get("memory_mb") or 1024)*instances)) >= quotas[entry]['limit']:
-                                        order_status = "PENDING"
-                                if entry == "instances":
-                                    if (quotas[entry]['reserved']+quotas[entry]['in_use']+(order_req.get("instances") or 1)) >= quotas[entry]['limit']:
-                                        order_status = "PENDING"
-
-                        order = WorkloadOrder()
-                        order.workload_id = workload.id
-                        order.instances = order_req.get("instances") or 1
-                        order.memory_mb = order_req.get("memory_mb") or 0
-                        order.status = order_status
-                        order.save()
-                        orders.append(order)
-
-        return {"workload":workload,"order":orders}
+        results = []
+        with session.begin():
+            workload = model_query(context, Workload, session=session).\
+                       filter_by(project_id=context.project_id).\
+                       filter_by(id=int(id)).first()
+            if workload:
+                if body.get("workload"):
+                    if body['workload'].get("name"):
+                        workload.name = body['workload'].get("name")
+                    if body['workload'].get("priority"):
+                        workload.priority = body['workload'].get("priority")
+                    workload.save(session=session)
+                order_reqs = body.get("order") or []
+                if isinstance(order_reqs, dict):
+                    order_reqs = [order_reqs]
+                outcomes = self._apply_orders(context, session, workload,
+                                              order_reqs, changes)
+                session.flush()
+                for order, error in outcomes:
+                    if order is None:
+                        results.append({"status": "Failure",
+                                        "message": error})
+                        continue
+                    orders.append(order)
+                    results.append({"id": order.id,
+                                    "status": order.status})
+                if orders or body.get("workload"):
+                    bump_versions(context, context.project_id, [workload.id],
+                                  session=session)
+        return workload, orders, results
+
+    def _apply_orders(self, context, session, workload, order_reqs,
+                      changes):
+        """
+        Update or create each requested order within session.
 
+        Returns an (order, None) or (None, error) pair per request.  Each
+        status change made is appended to changes["transitions"] as
+        (old, new), quota reserved for newly OPEN grow orders to
+        changes["reserved"], and reservations given up by orders leaving
+        OPEN to changes["released"] as (user id, reservations).
+        """
+        ids = [int(order_req["id"]) for order_req in order_reqs
+               if order_req.get("id")]
+        existing = {}
+        if ids:
+            query = model_query(context, WorkloadOrder, session=session).\
+                filter_by(workload_id=workload.id).\
+                filter(WorkloadOrder.id.in_(ids))
+            existing = dict((order.id, order) for order in query)
+
+        headroom = None
+        growing = None
+        outcomes = []
+        for order_req in order_reqs:
+
+            if order_req.get("id"):
+                # We're updating an existing order.
+                order = existing.get(int(order_req["id"]))
+                if order is None:
+                    outcomes.append((None, "No such order."))
+                    continue
+                status = order_req.get("status")
+                if status and status not in ORDER_STATUSES:
+                    outcomes.append((None, "Invalid status %s." % status))
+                    continue
+                if order.status in FINAL_STATUSES and \
+                        status != order.status:
+                    outcomes.append((None, "Order is already %s." %
+                                     order.status))
+                    continue
+
+                if order.status in ("OPEN", "PENDING", "WORKING"):
+                    if order_req.get("instances"):
+                        order.instances = order_req.get("instances")
+                    for key in ("memory_mb", "vcpus", "disk_gb"):
+                        if order_req.get(key):
+                            setattr(order, key, order_req.get(key))
+                if status and status != order.status:
+                    changes["transitions"].append((order.status, status))
+                    # Once the agent starts on a grow order, or gives up,
+                    # its boots count against quota instead.
+                    changes["released"].append(
+                        (order.user_id, order.take_reservations()))
+                    order.set_status(status)
+                outcomes.append((order, None))
+
+            elif order_req.get("instances") or order_req.get("memory_mb") \
+                    or order_req.get("flavor"):
+
+                # We're creating a new order.
+
+                # At some point we should check if we have
+                # an existing open/pending order and just update that.
+
+                order_status = "OPEN"
+                instances = order_req.get("instances") or 1
+                size = order_size(context, order_req)
+                if size is None:
+                    outcomes.append((None, "No such flavor %s." %
+                                     order_req["flavor"]))
+                    continue
+
+                # If it's a grow order, check and see if we're at capacity.
+
+                if instances > 0:
+                    # Only one grow order may be pending or open at a time.
+                    if growing is None:
+                        growing = model_query(context, WorkloadOrder,
+                                              session=session).\
+                            filter_by(workload_id=workload.id).\
+                            filter(or_(WorkloadOrder.status=="PENDING",WorkloadOrder.status=="OPEN")).\
+                            filter(WorkloadOrder.instances >= 1).first() is not None
+                    if growing:
+                        outcomes.append((None, "Existing pending or open order."))
+                        continue
+                    growing = True
+
+                    # We're growing, check to see if we can fit under quota limits.
+                    if headroom is None:
+                        headroom = Headroom(QUOTA_CACHE.get(
+                            context, context.project_id))
+                    reservations = None
+                    demand = Headroom.demand(instances, size["memory_mb"],
+                                             size["vcpus"])
+                    if headroom.admit(demand):
+                        reservations = reserve_order(
+                            context, context.project_id, context.user_id,
+                            demand)
+                    if reservations is None:
+                        order_status = "PENDING"
+
+                order = WorkloadOrder()
+                order.workload_id = workload.id
+                order.user_id = context.user_id
+                order.instances = instances
+                order.flavor_id = size["flavor_id"]
+                order.memory_mb = size["memory_mb"]
+                order.vcpus = size["vcpus"]
+                order.disk_gb = size["disk_gb"]
+                order.set_status(order_status)
+                if order_status == "OPEN" and instances > 0:
+                    order.hold_reservations(reservations)
+                    changes["reserved"].extend(reservations)
+                session.add(order)
+                changes["transitions"].append((None, order_status))
+                outcomes.append((order, None))
+
+            else:
+                outcomes.append((None, "Nothing to order."))
+
+        return outcomes
+
+    @METRICS.timed("delete")
     def delete(self, req, id):
         context = req.environ['nova.context']
         authorize(context)
@@ -328,14 +1084,545 @@ class WorkloadsController(wsgi.Controller):
                    filter_by(project_id=context.project_id).\
                    filter_by(id=int(id)).first()
         if workload:
-            result = model_query(context, Workload).\
-                    filter_by(project_id=context.project_id).\
-                    filter_by(id=int(id)).\
-                    soft_delete()
+            session = get_session()
+            with session.begin():
+                result = model_query(context, Workload, session=session).\
+                        filter_by(project_id=context.project_id).\
+                        filter_by(id=int(id)).\
+                        soft_delete()
+                # Nobody will carry out the workload's outstanding orders.
+                cancelled = model_query(context, WorkloadOrder, (
+                    WorkloadOrder.status,
+                    WorkloadOrder.user_id,
+                    WorkloadOrder.reservations), session=session).\
+                        filter_by(workload_id=workload.id).\
+                        filter(or_(WorkloadOrder.status == "PENDING",
+                                   WorkloadOrder.status == "OPEN")).all()
+                if cancelled:
+                    model_query(context, WorkloadOrder, session=session).\
+                        filter_by(workload_id=workload.id).\
+                        filter(or_(WorkloadOrder.status == "PENDING",
+                                   WorkloadOrder.status == "OPEN")).\
+                        update({"status": "ERROR",
+                                "error_at": timeutils.utcnow(),
+                                "reservations": None,
+                                "version": WorkloadOrder.version + 1},
+                               synchronize_session=False)
+                bump_versions(context, context.project_id, [workload.id],
+                              session=session)
+            for status, user_id, reservations in cancelled:
+                METRICS.transition(status, "ERROR")
+                if reservations:
+                    release_reservations(context, context.project_id,
+                                         user_id,
+                                         jsonutils.loads(reservations))
+            if cancelled:
+                QUOTA_CACHE.invalidate(context.project_id)
+            ORDER_WAITERS.notify([workload.id])
             return {"status":"SUCCESS"}
         else:
             return {"status":"FAILURE"}
 
+    @extensions.expected_errors(400)
+    @METRICS.timed("latency")
+    def latency(self, req):
+        """
+        How long the project's grow orders took to open and to fill.
+
+        Returns the count, p50 and p95 seconds from an order being placed
+        to it being OPEN and to it being FILLED, per workload and per
+        priority, over orders placed in the last ?window=N seconds, N
+        between 1 and max_latency_window.  Orders of deleted workloads are
+        left out.
+        """
+        context = req.environ['nova.context']
+        authorize(context, action='latency')
+        try:
+            window = int(req.GET.get("window",
+                                     CONF.workloads.latency_window))
+        except ValueError:
+            raise exc.HTTPBadRequest(
+                explanation=_("window must be an integer"))
+        if not 1 <= window <= CONF.workloads.max_latency_window:
+            raise exc.HTTPBadRequest(
+                explanation=_("window must be between 1 and %d") %
+                CONF.workloads.max_latency_window)
+
+        rows = model_query(context, WorkloadOrder, (
+            Workload.id,
+            Workload.name,
+            Workload.priority,
+            WorkloadOrder.created_at,
+            WorkloadOrder.opened_at,
+            WorkloadOrder.filled_at)).\
+                join((Workload,
+                Workload.id == WorkloadOrder.workload_id)).\
+                filter(Workload.project_id == context.project_id).\
+                filter(Workload.deleted == "").\
+                filter(WorkloadOrder.instances > 0).\
+                filter(WorkloadOrder.created_at >= timeutils.utcnow() -
+                       datetime.timedelta(seconds=window))
+
+        workloads = {}
+        priorities = {}
+        for workload_id, name, priority, created, opened, filled in rows:
+            for group in (
+                    workloads.setdefault(workload_id, {
+                        "id": workload_id, "name": name,
+                        "priority": priority, "orders": 0,
+                        "open": [], "fill": []}),
+                    priorities.setdefault(priority, {
+                        "priority": priority, "orders": 0,
+                        "open": [], "fill": []})):
+                group["orders"] += 1
+                if opened:
+                    group["open"].append((opened - created).total_seconds())
+                if filled:
+                    group["fill"].append((filled - created).total_seconds())
+
+        def summarise(group):
+            group["time_to_open"] = latency_summary(group.pop("open"))
+            group["time_to_fill"] = latency_summary(group.pop("fill"))
+            return group
+
+        return {"latency": {
+            "window": window,
+            "workloads": [summarise(workloads[key])
+                          for key in sorted(workloads)],
+            "priorities": [summarise(priorities[key])
+                           for key in sorted(priorities)]}}
+
+    @extensions.expected_errors(403)
+    def metrics(self, req):
+        """
+        Admin only: this API worker's handler timings and order counters.
+
+        ?format=prometheus returns them in the Prometheus text format.
+        """
+        context = req.environ['nova.context']
+        authorize(context, action='metrics')
+        if not context.is_admin:
+            raise exc.HTTPForbidden(
+                explanation=_("Workload metrics are admin only."))
+        if req.GET.get("format") == "prometheus":
+            return webob.Response(body=METRICS.prometheus().encode("utf-8"),
+                                  content_type="text/plain",
+                                  charset="utf-8")
+        return {"metrics": METRICS.snapshot()}
+
+
+class WorkloadReconciler(object):
+    """
+    Opens pending orders and requests scale-downs on a fixed interval.
+
+    This keeps order promotion and preemption off the agents' polling path:
+    show() only reads, and the write load on the orders table is set by
+    reconcile_interval rather than by how often agents poll.
+    """
+
+    def __init__(self):
+        self.stats = {"passes": 0,
+                      "errors": 0,
+                      "orders_opened": 0,
+                      "scale_downs": 0,
+                      "last_pass_seconds": 0.0,
+                      "max_pass_seconds": 0.0,
+                      "total_pass_seconds": 0.0}
+        self._timer = None
+
+    def pending_projects(self, context):
+        """Projects that have at least one PENDING order."""
+        workload_ids = [workload_id for (workload_id,) in
+                        model_query(context, WorkloadOrder, (
+                            WorkloadOrder.workload_id,)).\
+                        filter_by(status="PENDING").distinct()]
+        if not workload_ids:
+            return []
+        query = model_query(context, Workload, (Workload.project_id,)).\
+                filter(Workload.id.in_(workload_ids)).\
+                distinct()
+        return [project_id for (project_id,) in query]
+
+    @METRICS.timed("update_pending_orders")
+    def update_pending_orders(self, context, project_id):
+        """Open the project's PENDING orders that fit under quota."""
+        orders = model_query(context, WorkloadOrder, (
+            WorkloadOrder.id,
+            WorkloadOrder.workload_id,
+            WorkloadOrder.instances,
+            WorkloadOrder.memory_mb,
+            WorkloadOrder.vcpus,
+            WorkloadOrder.user_id)).\
+                filter_by(status="PENDING").\
+                join((Workload,
+                Workload.id == WorkloadOrder.workload_id)).\
+                filter_by(project_id = project_id).\
+                filter(Workload.deleted == "").\
+                order_by(asc(Workload.priority), asc(WorkloadOrder.id)).all()
+        if not orders:
+            return []
+
+        headroom = Headroom(QUOTA_CACHE.get(context, project_id))
+        sizer = OrderSizer(context)
+        demands = [sizer.demand(instances, memory_mb, vcpus)
+                   for _, _, instances, memory_mb, vcpus, _ in orders]
+        admitted = []
+        for i in headroom.admit_batch(demands):
+            order_id, workload_id, _, _, _, user_id = orders[i]
+            reservations = reserve_order(context, project_id, user_id,
+                                         demands[i])
+            if reservations is not None:
+                admitted.append((order_id, workload_id, user_id,
+                                 reservations))
+        if not admitted:
+            return []
+
+        LOG.debug("Updating order status to open %s",
+                  str([order[0] for order in admitted]))
+        opened = []
+        lost = []
+        session = get_session()
+        try:
+            with session.begin():
+                held = dict((order_id, jsonutils.dumps(reservations))
+                            for order_id, _, _, reservations in admitted)
+                promoted = model_query(context, WorkloadOrder,
+                                       session=session).\
+                    filter(WorkloadOrder.id.in_(list(held))).\
+                    filter_by(status="PENDING").\
+                    update({"status": "OPEN",
+                            "version": WorkloadOrder.version + 1,
+                            "opened_at": timeutils.utcnow(),
+                            "reservations": case(held,
+                                                 value=WorkloadOrder.id)},
+                           synchronize_session=False)
+                won = set(held)
+                if promoted != len(held):
+                    # Another reconciler got to some of them first; ours
+                    # are the ones now holding our reservations.
+                    won = set(order_id for order_id, reservations in
+                              model_query(context, WorkloadOrder, (
+                                  WorkloadOrder.id,
+                                  WorkloadOrder.reservations),
+                                  session=session).\
+                              filter(WorkloadOrder.id.in_(list(held)))
+                              if held[order_id] == reservations)
+                for order_id, workload_id, user_id, reservations in admitted:
+                    if order_id in won:
+                        opened.append((order_id, workload_id))
+                    else:
+                        METRICS.count("order_promotion_conflicts")
+                        lost.append((user_id, reservations))
+                if opened:
+                    bump_versions(context, project_id,
+                                  [workload_id for _, workload_id in opened],
+                                  session=session)
+        except Exception:
+            for _, _, user_id, reservations in admitted:
+                release_reservations(context, project_id, user_id,
+                                     reservations)
+            raise
+        for user_id, reservations in lost:
+            release_reservations(context, project_id, user_id, reservations)
+
+        METRICS.transition("PENDING", "OPEN", len(opened))
+        ORDER_WAITERS.notify([workload_id for _, workload_id in opened])
+        QUOTA_CACHE.invalidate(project_id)
+        return [order_id for order_id, _ in opened]
+
+    @METRICS.timed("expire_reservations")
+    def expire_reservations(self, context):
+        """Release the quota of OPEN grow orders past reservation_expire."""
+        cutoff = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.workloads.reservation_expire)
+        stale = model_query(context, WorkloadOrder, (
+            WorkloadOrder.id,
+            WorkloadOrder.workload_id,
+            WorkloadOrder.user_id,
+            WorkloadOrder.reservations)).\
+                filter_by(status="OPEN").\
+                filter(WorkloadOrder.reservations != None).\
+                filter(WorkloadOrder.opened_at < cutoff).all()
+        projects = workload_projects(
+            context, [order[1] for order in stale])
+        stale = [order for order in stale if order[1] in projects]
+        for order_id, workload_id, user_id, reservations in stale:
+            project_id = projects[workload_id]
+            # Only whoever clears the column rolls the reservations back.
+            if model_query(context, WorkloadOrder).\
+                    filter_by(id=order_id, status="OPEN").\
+                    filter(WorkloadOrder.reservations != None).\
+                    update({"reservations": None,
+                            "version": WorkloadOrder.version + 1},
+                           synchronize_session=False):
+                release_reservations(context, project_id, user_id,
+                                     jsonutils.loads(reservations))
+        METRICS.count("reservations_expired", len(stale))
+        return len(stale)
+
+    def expire_working(self, context):
+        """Mark ERROR the orders WORKING for more than working_timeout."""
+        return self._expire_orders(context, "WORKING",
+                                   WorkloadOrder.working_at,
+                                   CONF.workloads.working_timeout)
+
+    def expire_scale_downs(self, context):
+        """Mark ERROR the OPEN scale-downs no agent has started on."""
+        return self._expire_orders(context, "OPEN", WorkloadOrder.opened_at,
+                                   CONF.workloads.scale_down_timeout,
+                                   WorkloadOrder.instances < 0)
+
+    def _expire_orders(self, context, status, since, timeout, *criteria):
+        """Mark ERROR the orders in status since before timeout ago."""
+        cutoff = timeutils.utcnow() - datetime.timedelta(seconds=timeout)
+        stuck = model_query(context, WorkloadOrder, (
+            WorkloadOrder.id,
+            WorkloadOrder.workload_id)).\
+                filter_by(status=status).\
+                filter(since < cutoff).\
+                filter(*criteria).all()
+        if not stuck:
+            return 0
+
+        owners = workload_projects(
+            context, [workload_id for _, workload_id in stuck])
+        stuck = [order for order in stuck if order[1] in owners]
+        if not stuck:
+            return 0
+        projects = collections.defaultdict(list)
+        for _, workload_id in stuck:
+            projects[owners[workload_id]].append(workload_id)
+        session = get_session()
+        with session.begin():
+            # An agent taking or acknowledging the order meanwhile wins.
+            expired = model_query(context, WorkloadOrder, session=session).\
+                filter(WorkloadOrder.id.in_(
+                    [order_id for order_id, _ in stuck])).\
+                filter_by(status=status).\
+                filter(since < cutoff).\
+                update({"status": "ERROR",
+                        "error_at": timeutils.utcnow(),
+                        "version": WorkloadOrder.version + 1},
+                       synchronize_session=False)
+            for project_id, workload_ids in projects.items():
+                bump_versions(context, project_id, workload_ids,
+                              session=session)
+
+        if expired:
+            LOG.warning("Marked %d orders %s for more than %d seconds "
+                        "ERROR", expired, status, timeout)
+        METRICS.transition(status, "ERROR", expired)
+        ORDER_WAITERS.notify([workload_id for _, workload_id in stuck])
+        for project_id in projects:
+            QUOTA_CACHE.invalidate(project_id)
+        return expired
+
+    @METRICS.timed("preempt")
+    def preempt(self, context, project_id):
+        """Insert the scale-downs that make room for pending orders."""
+        pending = model_query(context, WorkloadOrder, (
+            WorkloadOrder.id,
+            WorkloadOrder.instances,
+            WorkloadOrder.memory_mb,
+            WorkloadOrder.vcpus,
+            Workload.priority)).\
+                filter_by(status="PENDING").\
+                filter(WorkloadOrder.instances > 0).\
+                join((Workload,
+                Workload.id == WorkloadOrder.workload_id)).\
+                filter_by(project_id = project_id).\
+                filter(Workload.deleted == "").\
+                order_by(asc(Workload.priority), asc(WorkloadOrder.id)).all()
+        if not pending:
+            return 0
+
+        workloads = model_query(context, Workload, (
+            Workload.id,
+            Workload.name,
+            Workload.priority)).\
+                filter_by(project_id = project_id).all()
+        usage = instance_usage(context, project_id,
+                               set(name for _, name, _ in workloads))
+        # What each workload could give up, by quota resource, and its
+        # average instance size.
+        footprint = {}
+        sizes = {}
+        for workload_id, name, _ in workloads:
+            count, ram, cores = usage.get(name, (0, 0, 0))
+            footprint[workload_id] = collections.Counter(
+                {"instances": count, "ram": int(ram), "cores": int(cores)})
+            sizes[workload_id] = dict(
+                (resource, footprint[workload_id][resource] // count
+                 if count else 0)
+                for resource in Headroom.RESOURCES)
+
+        headroom = Headroom(QUOTA_CACHE.get(context, project_id))
+        sizer = OrderSizer(context)
+        in_flight = collections.defaultdict(collections.Counter)
+        shrinking = model_query(context, WorkloadOrder, (
+            WorkloadOrder.workload_id,
+            WorkloadOrder.serves_order_id,
+            WorkloadOrder.instances,
+            WorkloadOrder.memory_mb,
+            WorkloadOrder.vcpus)).\
+                filter(or_(
+                WorkloadOrder.status == "OPEN",
+                WorkloadOrder.status == "WORKING"
+                )).\
+                filter(WorkloadOrder.instances < 0).\
+                join((Workload,
+                Workload.id == WorkloadOrder.workload_id)).\
+                filter_by(project_id = project_id).\
+                filter(Workload.deleted == "")
+        for (workload_id, serves_order_id, instances, memory_mb,
+             vcpus) in shrinking:
+            freed = sizer.demand(-instances, memory_mb, vcpus)
+            if serves_order_id:
+                in_flight[serves_order_id].update(freed)
+            else:
+                # Not preemption; whoever gets there first can have it.
+                headroom.release(freed)
+            if workload_id in footprint:
+                footprint[workload_id].subtract(freed)
+
+        victims = sorted(workloads, key=lambda w: (-(w[2] or 0), w[0]))
+        takes = []
+        for order_id, instances, memory_mb, vcpus, priority in pending:
+            demand = sizer.demand(instances, memory_mb, vcpus)
+            credit = in_flight[order_id]
+            headroom.release(dict((resource, credit[resource])
+                                  for resource in Headroom.RESOURCES))
+            if headroom.admit(demand):
+                continue
+
+            short = headroom.shortfall(demand)
+            order_takes = []
+            for workload_id, _, victim_priority in victims:
+                if victim_priority <= priority or not any(short.values()):
+                    break
+                count = footprint[workload_id]["instances"]
+                if count <= 0:
+                    continue
+                # Enough instances to cover whichever resource is
+                # shortest.
+                per_instance = sizes[workload_id]
+                need = max([int(math.ceil(float(amount) /
+                                          per_instance[resource]))
+                            for resource, amount in short.items()
+                            if amount and per_instance[resource] > 0] or [0])
+                take = min(count, need)
+                if take <= 0:
+                    continue
+                order_takes.append((workload_id, order_id, take))
+                for resource in short:
+                    short[resource] = max(
+                        0, short[resource] - take * per_instance[resource])
+            if any(short.values()):
+                # Shrinking lower priority workloads can't make room.
+                continue
+            for workload_id, _, take in order_takes:
+                freed = dict((resource, take * amount) for resource, amount
+                             in sizes[workload_id].items())
+                footprint[workload_id].subtract(freed)
+                headroom.release(freed)
+            headroom.admit(demand)
+            takes.extend(order_takes)
+
+        scale_downs = []
+        for workload_id, order_id, take in takes:
+            order = WorkloadOrder()
+            order.workload_id = workload_id
+            order.serves_order_id = order_id
+            order.instances = -take
+            order.memory_mb = sizes[workload_id]["ram"]
+            order.vcpus = sizes[workload_id]["cores"]
+            order.set_status("OPEN")
+            scale_downs.append(order)
+
+        if scale_downs:
+            session = get_session()
+            with session.begin():
+                for order in scale_downs:
+                    order.save(session=session)
+                bump_versions(context, project_id,
+                              [order.workload_id for order in scale_downs],
+                              session=session)
+            ORDER_WAITERS.notify([order.workload_id for order in scale_downs])
+            QUOTA_CACHE.invalidate(project_id)
+            METRICS.transition(None, "OPEN", len(scale_downs))
+            METRICS.count("scale_downs_inserted", len(scale_downs))
+            METRICS.count("instances_preempted",
+                          sum(take for _, _, take in takes))
+        return len(scale_downs)
+
+    @METRICS.timed("reconcile")
+    def reconcile(self, context):
+        """Run one pass over every project with pending orders."""
+        start = time.time()
+        opened = scale_downs = 0
+        projects = []
+        try:
+            try:
+                self.expire_reservations(context)
+                self.expire_working(context)
+                self.expire_scale_downs(context)
+            except Exception:
+                self.stats["errors"] += 1
+                LOG.exception("Workload reconciler failed to expire orders")
+            try:
+                projects = self.pending_projects(context)
+            except Exception:
+                self.stats["errors"] += 1
+                LOG.exception("Workload reconciler failed to list projects")
+            for project_id in projects:
+                try:
+                    opened += len(self.update_pending_orders(context,
+                                                             project_id))
+                    scale_downs += self.preempt(context, project_id)
+                except Exception:
+                    self.stats["errors"] += 1
+                    METRICS.count("reconcile_project_errors")
+                    LOG.exception("Workload reconciler failed for project "
+                                  "%s", project_id)
+        finally:
+            elapsed = time.time() - start
+            self.stats["passes"] += 1
+            self.stats["orders_opened"] += opened
+            self.stats["scale_downs"] += scale_downs
+            self.stats["last_pass_seconds"] = elapsed
+            self.stats["total_pass_seconds"] += elapsed
+            self.stats["max_pass_seconds"] = max(
+                self.stats["max_pass_seconds"], elapsed)
+        LOG.info("Workload reconciler pass: opened %(opened)d orders, "
+                 "requested %(scale_downs)d scale-downs in %(elapsed).3fs "
+                 "(quota cache %(hits)d hits, %(misses)d misses)",
+                 dict(QUOTA_CACHE.stats(), opened=opened,
+                      scale_downs=scale_downs, elapsed=elapsed))
+        LOG.debug("Workload metrics: %s", METRICS.snapshot())
+
+    def start(self):
+        """Reconcile every reconcile_interval seconds until stopped."""
+        context = nova_context.get_admin_context()
+        self._timer = loopingcall.FixedIntervalLoopingCall(
+            self.reconcile, context)
+        return self._timer.start(interval=CONF.workloads.reconcile_interval)
+
+    def stop(self):
+        if self._timer:
+            self._timer.stop()
+
+
+RECONCILER = None
+
+
+def start_reconciler():
+    """Start the in-process reconciler once per API service."""
+    global RECONCILER
+    if RECONCILER is None:
+        RECONCILER = WorkloadReconciler()
+        RECONCILER.start()
+    return RECONCILER
+
 
 class Workloads(extensions.V3APIExtensionBase):
     """API Workloads information."""
@@ -346,7 +1633,10 @@ class Workloads(extensions.V3APIExtensionBase):
 
     def get_resources(self):
         resources = [
-            extensions.ResourceExtension(ALIAS, WorkloadsController())
+            extensions.ResourceExtension(ALIAS, WorkloadsController(),
+                                         collection_actions={
+                                             'latency': 'GET',
+                                             'metrics': 'GET'})
             ]
         return resources
 
@@ -357,6 +1647,11 @@ class Workloads(extensions.V3APIExtensionBase):
 class Workload(BASE, NovaBase):
     """Represents a Workload that can be made up of multiple VMs."""
     __tablename__ = 'workloads'
+    __table_args__ = (
+        Index('uniq_workloads0id', 'id', unique=True),
+        Index('workloads_project_id_deleted_priority_idx',
+              'project_id', 'deleted', 'priority'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     deleted = Column(String(36), default="")
 
@@ -366,19 +1661,80 @@ class Workload(BASE, NovaBase):
 
     priority = Column(Integer)
     last_checkin = Column(DateTime)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
+class WorkloadProject(BASE, NovaBase):
+    """Per-project version counter behind the workload listing's ETag."""
+    __tablename__ = 'workload_projects'
+    project_id = Column(String(255), primary_key=True)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
 
 class WorkloadOrder(BASE, NovaBase):
     """Represents a Order related to a Workload."""
     __tablename__ = 'workload_orders'
+    __table_args__ = (
+        Index('workload_orders_workload_id_status_deleted_idx',
+              'workload_id', 'status', 'deleted'),
+        Index('workload_orders_status_deleted_workload_id_idx',
+              'status', 'deleted', 'workload_id'),
+        Index('workload_orders_serves_order_id_idx', 'serves_order_id'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     status = Column(String(255))
 
-    workload_id = Column(Integer)
+    workload_id = Column(Integer, ForeignKey('workloads.id'))
     instances = Column(Integer)
     memory_mb = Column(Integer)
+    vcpus = Column(Integer)
+    disk_gb = Column(Integer)
+    # The flavor a grow order was sized from, if any.
+    flavor_id = Column(String(255))
+    # For a scale-down made by preemption, the pending order it frees
+    # capacity for.
+    serves_order_id = Column(Integer, ForeignKey('workload_orders.id'))
+    # Ids of the quota reservations an OPEN grow order holds, as JSON.
+    reservations = Column(Text)
+    # Who placed the order; its reservations are held for them.
+    user_id = Column(String(255))
+    # Bumped by every change, which is made only if it hasn't moved since
+    # the order was read.
+    version = Column(Integer, nullable=False, server_default='0')
+    __mapper_args__ = {'version_id_col': version}
+    pending_at = Column(DateTime)
+    opened_at = Column(DateTime)
+    working_at = Column(DateTime)
+    filled_at = Column(DateTime)
+    error_at = Column(DateTime)
     workload = orm.relationship(Workload,
                                 foreign_keys=workload_id,
                                 primaryjoin='and_('
                                     'WorkloadOrder.workload_id == Workload.id,'
                                     'Workload.deleted == 0,'
                                     'WorkloadOrder.deleted == 0)')
+
+    def set_status(self, status):
+        """Move the order to status, stamping when it got there."""
+        self.status = status
+        setattr(self, STATUS_TIMESTAMPS[status], timeutils.utcnow())
+
+    def hold_reservations(self, reservations):
+        self.reservations = jsonutils.dumps(reservations)
+
+    def take_reservations(self):
+        """Detach and return the quota reservations the order holds."""
+        reservations = jsonutils.loads(self.reservations) \
+            if self.reservations else []
+        self.reservations = None
+        return reservations
+
+
+def main():
+    """Run the reconciler as a standalone worker."""
+    config.parse_args(sys.argv)
+    logging.setup(CONF, "nova")
+    objects.register_all()
+    WorkloadReconciler().start().wait()
+
+
+if __name__ == "__main__":
+    main()